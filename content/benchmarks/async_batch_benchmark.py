@@ -0,0 +1,104 @@
+"""Throughput of SagemakerAsyncEndpoint with several prompts, one by one vs batched generate().
+
+The endpoint, S3 and SQS are in-memory stand-ins. Every AWS call takes API_LATENCY
+seconds and every inference INFERENCE_LATENCY seconds, the endpoint runs the
+inferences in parallel. Completion is detected with SQSNotifier.
+
+Requires the lab-01 backend requirements, no AWS account:
+
+    python benchmarks/async_batch_benchmark.py
+"""
+import json
+import threading
+import time
+
+from stubs import BACKEND_APP_DIR, FakeS3, FakeSQS, add_to_path
+
+add_to_path(BACKEND_APP_DIR)
+from llm.sagemaker_async_endpoint import SagemakerAsyncEndpoint, SQSNotifier  # noqa: E402
+from sagemaker_content_handler import content_handler  # noqa: E402
+
+API_LATENCY = 0.03
+INFERENCE_LATENCY = 0.5
+BUCKET = "sagemaker-bucket"
+
+
+class FakeSageMakerRuntime:
+    """Asynchronous endpoint stand-in writing the output and the notification after the inference."""
+
+    def __init__(self, s3, sqs):
+        self.s3 = s3
+        self.sqs = sqs
+        self.invocations = 0
+        self.lock = threading.Lock()
+
+    def invoke_endpoint_async(self, EndpointName, InputLocation, **kwargs):
+        time.sleep(API_LATENCY)
+        with self.lock:
+            self.invocations += 1
+            inference_id = f"id-{self.invocations}"
+        output_url = f"s3://{BUCKET}/out/{inference_id}.out"
+
+        def finish():
+            time.sleep(INFERENCE_LATENCY)
+            self.s3.put_object(Bucket=BUCKET, Key=f"out/{inference_id}.out",
+                               Body=json.dumps([{"generated_text": f"answer {inference_id}"}]))
+            self.sqs.send(json.dumps({
+                "inferenceId": inference_id,
+                "invocationStatus": "Completed",
+                "responseParameters": {"outputLocation": output_url},
+            }))
+        threading.Thread(target=finish, daemon=True).start()
+        return {
+            "InferenceId": inference_id,
+            "OutputLocation": output_url,
+            "FailureLocation": f"s3://{BUCKET}/fail/{inference_id}.out",
+        }
+
+
+class FakeSageMaker:
+    def describe_endpoint(self, EndpointName):
+        time.sleep(API_LATENCY)
+        return {"ProductionVariants": [{"CurrentInstanceCount": 1}]}
+
+
+def build_llm():
+    # construct() skips __init__, which creates the boto3 clients
+    s3, sqs = FakeS3(latency=API_LATENCY), FakeSQS()
+    llm = SagemakerAsyncEndpoint.construct(
+        endpoint_name="benchmark-endpoint",
+        region_name="us-east-1",
+        content_handler=content_handler,
+        client=FakeSageMakerRuntime(s3, sqs),
+        s3_client=s3,
+        sm_client=FakeSageMaker(),
+        input_bucket=BUCKET,
+        input_prefix="async-endpoint-inputs",
+        completion_notifier=SQSNotifier("queue", sqs),
+        async_semaphores={},
+    )
+    return llm
+
+
+def main():
+    for prompts in (4, 16, 64):
+        texts = [f"Question {i}?" for i in range(prompts)]
+
+        llm = build_llm()
+        start = time.perf_counter()
+        sequential = [llm._call(text) for text in texts]
+        sequential_time = time.perf_counter() - start
+
+        llm = build_llm()
+        start = time.perf_counter()
+        result = llm.generate(texts)
+        batched_time = time.perf_counter() - start
+        batched = [g[0].text for g in result.generations]
+        assert len(batched) == len(sequential) == prompts
+
+        print(f"{prompts} prompts: one by one {sequential_time:.2f} s ({prompts / sequential_time:.1f} prompts/s), "
+              f"batched {batched_time:.2f} s ({prompts / batched_time:.1f} prompts/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Time to result of the SagemakerAsyncEndpoint completion notifiers.
+
+A simulated asynchronous endpoint finishes the requests after random latencies,
+writes the outputs to an in-memory S3 and publishes the success notifications to
+an in-memory SQS queue. The benchmark measures how long after the completion each
+waiter gets its result with S3PollingNotifier and SQSNotifier, and how many
+receive_message calls the SQS waiters make while the queue holds a notification
+of another consumer.
+
+Requires the lab-01 backend requirements, no AWS account:
+
+    python benchmarks/async_notifier_benchmark.py
+"""
+import json
+import random
+import threading
+import time
+
+from stubs import BACKEND_APP_DIR, FakeS3, FakeSQS, add_to_path, percentile
+
+add_to_path(BACKEND_APP_DIR)
+from llm.sagemaker_async_endpoint import S3PollingNotifier, SQSNotifier  # noqa: E402
+
+BUCKET = "sagemaker-bucket"
+REQUESTS = 20
+
+
+def notification(inference_id, key):
+    return json.dumps({
+        "inferenceId": inference_id,
+        "invocationStatus": "Completed",
+        "responseParameters": {"outputLocation": f"s3://{BUCKET}/{key}"},
+    })
+
+
+def complete_later(s3, sqs, inference_id, key, latency):
+    """Simulate the endpoint finishing an inference after latency seconds."""
+    def finish():
+        time.sleep(latency)
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b'[{"generated_text": "ok"}]')
+        sqs.send(notification(inference_id, key))
+    threading.Thread(target=finish, daemon=True).start()
+
+
+def time_to_result(notifier, s3, sqs, latencies):
+    """Start one waiter per request and return the delays between completion and result."""
+    delays = [None] * len(latencies)
+    start = time.monotonic()
+
+    def wait(i):
+        key = f"out/{i}.out"
+        notifier.wait(f"id-{i}", f"s3://{BUCKET}/{key}", f"s3://{BUCKET}/fail/{i}", s3)
+        delays[i] = time.monotonic() - start - latencies[i]
+
+    threads = [threading.Thread(target=wait, args=(i,)) for i in range(len(latencies))]
+    for t in threads:
+        t.start()
+    for i, latency in enumerate(latencies):
+        complete_later(s3, sqs, f"id-{i}", f"out/{i}.out", latency)
+    for t in threads:
+        t.join()
+    return delays
+
+
+def foreign_notification_calls(notifier, sqs, seconds=3.0, waiters=4):
+    """Count receive_message calls while a notification of another consumer stays in the queue."""
+    sqs.send(notification("another-process", "out/other.out"))
+    s3 = FakeS3()
+    latencies = [seconds] * waiters
+    start_calls = sqs.receive_calls
+    time_to_result(notifier, s3, sqs, latencies)
+    return sqs.receive_calls - start_calls
+
+
+def main():
+    random.seed(0)
+    latencies = [random.uniform(0.5, 3.0) for _ in range(REQUESTS)]
+
+    print(f"Time from completion to result, {REQUESTS} concurrent requests finishing after 0.5-3 s")
+    s3, sqs = FakeS3(latency=0.01), FakeSQS()
+    delays = time_to_result(S3PollingNotifier(), s3, sqs, latencies)
+    print(f"  S3PollingNotifier: p50 {percentile(delays, 50):.2f} s, p95 {percentile(delays, 95):.2f} s, "
+          f"{s3.calls} S3 calls")
+    s3, sqs = FakeS3(latency=0.01), FakeSQS()
+    delays = time_to_result(SQSNotifier("queue", sqs), s3, sqs, latencies)
+    print(f"  SQSNotifier:       p50 {percentile(delays, 50):.2f} s, p95 {percentile(delays, 95):.2f} s, "
+          f"{s3.calls} S3 calls, {sqs.receive_calls} receive_message calls")
+
+    print("receive_message calls of 4 waiters over 3 s with a notification of another consumer in the queue")
+    sqs = FakeSQS()
+    calls = foreign_notification_calls(SQSNotifier("queue", sqs, release_delay=0, max_release_delay=0), sqs)
+    print(f"  released immediately:     {calls}")
+    sqs = FakeSQS()
+    calls = foreign_notification_calls(SQSNotifier("queue", sqs), sqs)
+    print(f"  released with backoff:    {calls}")
+
+
+if __name__ == "__main__":
+    main()
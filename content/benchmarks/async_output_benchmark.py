@@ -0,0 +1,74 @@
+"""Peak memory and time to parse SageMaker async outputs, read at once vs open_output.
+
+The original _transform_output read the whole body and parsed it with json.loads.
+open_output reads outputs up to the threshold at once and streams larger ones,
+downloaded with parallel ranged GETs and parsed one item at a time by
+read_generated_text. Peak memory is measured with tracemalloc.
+
+Requires the lab-01 backend requirements, no AWS account:
+
+    python benchmarks/async_output_benchmark.py
+"""
+import gzip
+import json
+import time
+import tracemalloc
+
+from stubs import BACKEND_APP_DIR, FakeS3, add_to_path
+
+add_to_path(BACKEND_APP_DIR)
+from llm.sagemaker_async_endpoint import open_output, read_generated_text  # noqa: E402
+
+BUCKET = "sagemaker-bucket"
+THRESHOLD = 64 * 1024 * 1024
+CASES = [
+    ("single 30M-char generation", 1, 30_000_000),
+    ("batch of 20 x 2M chars", 20, 2_000_000),
+    ("batch of 5,000 x 20K chars", 5_000, 20_000),
+]
+
+
+def payload(items, chars):
+    text = ("token é " * (chars // 8 + 1))[:chars]
+    return json.dumps([{"generated_text": text} for _ in range(items)]).encode("utf-8")
+
+
+def measure(parse):
+    tracemalloc.start()
+    start = time.perf_counter()
+    text = parse()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return text, peak, elapsed
+
+
+def main():
+    for name, items, chars in CASES:
+        s3 = FakeS3()
+        s3.put_object(Bucket=BUCKET, Key="out", Body=payload(items, chars))
+        s3.put_object(Bucket=BUCKET, Key="out.gz", Body=gzip.compress(s3.objects[(BUCKET, "out")], 1))
+        size = len(s3.objects[(BUCKET, "out")])
+        print(f"{name}, {size / 1e6:.0f} MB, {'streamed' if size > THRESHOLD else 'read at once'}")
+
+        def read_at_once():
+            body = s3.get_object(Bucket=BUCKET, Key="out")["Body"].read()
+            return "".join(item["generated_text"] for item in json.loads(body.decode("utf-8")))
+
+        def parse(key):
+            response = s3.get_object(Bucket=BUCKET, Key=key)
+            with open_output(response, s3, f"s3://{BUCKET}/{key}", THRESHOLD, stream_threshold=THRESHOLD) as output:
+                return read_generated_text(output)
+
+        expected = None
+        for label, run in [("json.loads of the body", read_at_once),
+                           ("open_output", lambda: parse("out")),
+                           ("open_output, gzip", lambda: parse("out.gz"))]:
+            text, peak, elapsed = measure(run)
+            expected = expected or text
+            assert text == expected
+            print(f"  {label:<24} peak {peak / 1e6:.0f} MB, {elapsed:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
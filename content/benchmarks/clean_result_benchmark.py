@@ -0,0 +1,97 @@
+"""Equivalence and speed of clean_result against the original regex version.
+
+The original clean_result was re.sub("\\s+", " ", text).replace("...", ""). The
+current one collapses whitespace with str.split and also drops highlight tags.
+The script checks that both return the same string for Kendra excerpts without
+highlight tags: the excerpts and passages in kendra_responses/, the same texts with
+tabs, newlines, ellipses and unicode whitespace put in, and random strings over an
+alphabet of such characters. It then times both on the excerpts.
+
+Requires the lab-02 RAG app requirements, no AWS account:
+
+    python benchmarks/clean_result_benchmark.py
+"""
+import json
+import os
+import random
+import re
+import time
+
+from stubs import RAG_APP_DIR, add_to_path
+
+add_to_path(RAG_APP_DIR)
+from kendra.kendra_results import clean_result  # noqa: E402
+
+RESPONSES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kendra_responses")
+# ASCII and unicode whitespace, matched by \s and str.split alike
+WHITESPACE = [" ", "\t", "\n", "\r", "\f", "\v", "\x1c", "\x1f", "\x85", "\xa0", "\u2009", "\u2028", "\u3000"]
+# Not whitespace for either, kept as a word character
+NOT_WHITESPACE = "\ufeff"
+RANDOM_STRINGS = 50_000
+RUNS = 50
+
+
+def original_clean_result(res_text):
+    """clean_result as it was before the str.split version."""
+    return re.sub(r"\s+", " ", res_text).replace("...", "")
+
+
+def kendra_texts():
+    texts = []
+    with open(os.path.join(RESPONSES_DIR, "query.json")) as f:
+        for response in json.load(f).values():
+            for r in response["ResultItems"]:
+                texts.append(r["DocumentExcerpt"]["Text"])
+                texts.extend(a["Value"]["TextWithHighlightsValue"]["Text"] for a in r["AdditionalAttributes"])
+    with open(os.path.join(RESPONSES_DIR, "retrieve.json")) as f:
+        for response in json.load(f).values():
+            texts.extend(r["Content"] for r in response["ResultItems"])
+    return texts
+
+
+def noisy(rnd, text):
+    """Put runs of whitespace and ellipses between the words of a text, and at its ends."""
+    noise = WHITESPACE + ["...", "....", ". . .", "…"]
+    words = text.split(" ")
+    out = [rnd.choice(noise) * rnd.randint(0, 2)]
+    for word in words:
+        out.append(word)
+        out.append(" " if rnd.random() < 0.7 else "".join(rnd.choice(noise) for _ in range(rnd.randint(1, 4))))
+    return "".join(out)
+
+
+def check(texts):
+    rnd = random.Random(0)
+    cases = list(texts) + [noisy(rnd, t) for t in texts for _ in range(20)]
+    alphabet = WHITESPACE + [".", "a", "é", "…", "x y", NOT_WHITESPACE]
+    cases += ["".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 12))) for _ in range(RANDOM_STRINGS)]
+    for text in cases:
+        assert clean_result(text) == original_clean_result(text), repr(text)
+    return len(cases)
+
+
+def best_time(fn, texts):
+    best = float("inf")
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        for text in texts:
+            fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best / len(texts) * 1e6
+
+
+def main():
+    texts = kendra_texts()
+    print(f"{check(texts)} texts: clean_result equals the original byte for byte")
+    rnd = random.Random(1)
+    for name, sample in [("Kendra excerpts and passages", texts),
+                         ("with whitespace and ellipsis noise", [noisy(rnd, t) for t in texts])]:
+        original = best_time(original_clean_result, sample)
+        current = best_time(clean_result, sample)
+        chars = sum(map(len, sample)) / len(sample)
+        print(f"  {name:<36} {chars:.0f} chars: original {original:.2f} us, clean_result {current:.2f} us, "
+              f"{original / current:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Load test of the Gradio chat function against a stub streaming endpoint.
+
+The ChatInterface function of create_generate runs in one thread per request, as
+in the Gradio workers, against a sagemaker-runtime stand-in that streams TOKENS
+TGI token events, one every TOKEN_LATENCY seconds. One heavy user sends HEAVY
+requests at once while LIGHT_USERS other users send LIGHT_EACH requests each.
+The script reports the throughput, the latencies of both kinds of users and the
+maximum number of concurrent streams, with one slot (one request at a time), and
+with several slots shared first in first out or by FairScheduler.
+
+Requires gradio and boto3, no AWS account:
+
+    python benchmarks/gradio_load_test.py
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from stubs import NOTEBOOKS_DIR, add_to_path, percentile
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+add_to_path(NOTEBOOKS_DIR)
+import gradio_app  # noqa: E402
+
+TOKENS = 20
+TOKEN_LATENCY = 0.0025
+SLOTS = 8
+HEAVY = 40
+LIGHT_USERS = 16
+LIGHT_EACH = 2
+LIGHT_INTERVAL = 0.03
+
+
+class StubStream:
+    """Event stream of a TGI response, one PayloadPart per token."""
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            for i in range(TOKENS):
+                if self.closed:
+                    return
+                time.sleep(TOKEN_LATENCY)
+                event = {"token": {"id": i, "text": f" token{i}", "special": False, "logprob": -0.1}}
+                yield {"PayloadPart": {"Bytes": f"data:{json.dumps(event)}\n\n".encode("utf-8")}}
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.runtime.stream_ended()
+
+
+class StubRuntime:
+    """sagemaker-runtime stand-in counting the concurrent streams."""
+
+    def __init__(self):
+        self.streams = 0
+        self.max_streams = 0
+        self.lock = threading.Lock()
+
+    def invoke_endpoint_with_response_stream(self, EndpointName, Body, ContentType):
+        with self.lock:
+            self.streams += 1
+            self.max_streams = max(self.max_streams, self.streams)
+        return {"Body": StubStream(self)}
+
+    def stream_ended(self):
+        with self.lock:
+            self.streams -= 1
+
+
+class StubSession:
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def client(self, service_name, config=None):
+        return self.runtime
+
+
+class FifoScheduler:
+    """Slots handed out first in first out, like the Gradio queue without FairScheduler."""
+
+    def __init__(self, max_concurrency):
+        self.semaphore = threading.Semaphore(max_concurrency)
+
+    @contextmanager
+    def slot(self, user):
+        with self.semaphore:
+            yield
+
+
+def run(concurrency, scheduler_class):
+    gradio_app.FairScheduler = scheduler_class
+    runtime = StubRuntime()
+    generate = gradio_app.create_generate("stub-endpoint", session=StubSession(runtime), concurrency_count=concurrency)
+    latencies = {"heavy": [], "light": []}
+    first_tokens = []
+    lock = threading.Lock()
+
+    def request(user, kind, delay):
+        time.sleep(delay)
+        start = time.perf_counter()
+        first_token = None
+        for _ in generate("What is Amazon SageMaker?", [], SimpleNamespace(username=None, session_hash=user)):
+            first_token = first_token or time.perf_counter() - start
+        with lock:
+            latencies[kind].append(time.perf_counter() - start)
+            if kind == "light":
+                first_tokens.append(first_token)
+
+    threads = [threading.Thread(target=request, args=("heavy", "heavy", 0)) for _ in range(HEAVY)]
+    threads += [threading.Thread(target=request, args=(f"user-{i}", "light", 0.005 + LIGHT_INTERVAL * j))
+                for i in range(LIGHT_USERS) for j in range(LIGHT_EACH)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    assert runtime.streams == 0 and runtime.max_streams <= concurrency
+    return len(threads) / elapsed, latencies, first_tokens, runtime.max_streams
+
+
+def main():
+    original_scheduler = gradio_app.FairScheduler
+    print(f"{HEAVY} requests of one user at once, {LIGHT_USERS} users sending {LIGHT_EACH} each, "
+          f"{TOKENS} tokens of {TOKEN_LATENCY * 1000:.1f} ms per response")
+    for name, concurrency, scheduler_class in [
+        ("1 slot", 1, original_scheduler),
+        (f"{SLOTS} slots, FIFO", SLOTS, FifoScheduler),
+        (f"{SLOTS} slots, fair", SLOTS, original_scheduler),
+    ]:
+        throughput, latencies, first_tokens, max_streams = run(concurrency, scheduler_class)
+        light, heavy = latencies["light"], latencies["heavy"]
+        print(f"  {name:<14} {throughput:.0f} req/s, light users p50 {percentile(light, 50) * 1000:.0f} ms "
+              f"p95 {percentile(light, 95) * 1000:.0f} ms, first token p95 {percentile(first_tokens, 95) * 1000:.0f} ms, "
+              f"heavy user p95 {percentile(heavy, 95) * 1000:.0f} ms, max {max_streams} streams")
+    gradio_app.FairScheduler = original_scheduler
+
+
+if __name__ == "__main__":
+    main()
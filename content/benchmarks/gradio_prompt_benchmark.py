@@ -0,0 +1,103 @@
+"""Prompt size and build time of the Gradio chat, format_prompt vs PromptBuilder.
+
+Synthetic chats are replayed turn by turn. For each prompt the script records the
+payload size, whether it exceeds the token budget, the build time and how much of
+the previous prompt it starts with, which the prefix cache of the model server can
+reuse. It also checks that PromptBuilder returns the same prompts as format_prompt
+within the budget, and that chats sharing their last turn do not share states.
+
+Requires gradio and boto3, no AWS account:
+
+    python benchmarks/gradio_prompt_benchmark.py
+"""
+import os
+import random
+import time
+
+from stubs import NOTEBOOKS_DIR, add_to_path
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+add_to_path(NOTEBOOKS_DIR)
+from gradio_app import PromptBuilder, estimate_tokens, format_prompt, system_prompt  # noqa: E402
+
+MAX_PROMPT_TOKENS = 896
+WORDS = ["aws", "lambda", "bedrock", "the", "a", "sagemaker", "endpoint"]
+
+
+def text(rnd, words):
+    return " ".join(rnd.choice(WORDS) for _ in range(words))
+
+
+def check_prompts():
+    rnd = random.Random(0)
+    builder = PromptBuilder(system_prompt, max_prompt_tokens=10 ** 9)
+    history = []
+    for _ in range(30):
+        message = text(rnd, 10)
+        assert builder.build(message, history) == format_prompt(message, history, system_prompt)
+        history.append([message, text(rnd, 40)])
+    # Two chats with the same last turn and different earlier turns, in two sessions and without session ids
+    last_turn = ["same question", "same answer"]
+    first = [["first chat", "first answer"], last_turn]
+    second = [["second chat", "second answer"], last_turn]
+    for chat, session_id in [(first, "a"), (second, "b"), (first, "a"), (first, None), (second, None)]:
+        assert builder.build("next", chat, session_id) == format_prompt("next", chat, system_prompt)
+    print("PromptBuilder prompts equal format_prompt within the budget, chats do not share states")
+
+
+def shared_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def replay(build, messages):
+    history = []
+    elapsed = 0.0
+    sizes = []
+    over_budget = 0
+    reused = 0
+    total = 0
+    previous = ""
+    for message, response in messages:
+        start = time.perf_counter()
+        prompt = build(message, history)
+        elapsed += time.perf_counter() - start
+        sizes.append(len(prompt.encode("utf-8")))
+        over_budget += estimate_tokens(prompt) > MAX_PROMPT_TOKENS
+        if previous:
+            reused += estimate_tokens(previous[:shared_prefix(previous, prompt)])
+            total += estimate_tokens(previous)
+        previous = prompt
+        history.append([message, response])
+    return sizes, over_budget, elapsed / len(messages), reused / max(total, 1)
+
+
+def session_builder(drop_turns, session_id):
+    builder = PromptBuilder(system_prompt, MAX_PROMPT_TOKENS, drop_turns=drop_turns)
+    return lambda message, history: builder.build(message, history, session_id)
+
+
+def main():
+    check_prompts()
+    for turns in (100, 400):
+        rnd = random.Random(1)
+        messages = [(text(rnd, rnd.randint(5, 30)), text(rnd, rnd.randint(20, 150))) for _ in range(turns)]
+        print(f"{turns}-turn chat")
+        for name, build in [
+            ("format_prompt", lambda m, h: format_prompt(m, h, system_prompt)),
+            ("PromptBuilder, drop 4", session_builder(4, "session")),
+            ("PromptBuilder, drop 1", session_builder(1, "session")),
+            ("PromptBuilder, no session", session_builder(4, None)),
+        ]:
+            sizes, over_budget, per_turn, reuse = replay(build, messages)
+            print(f"  {name:<26} last payload {sizes[-1] / 1024:.1f} KiB, max {max(sizes) / 1024:.1f} KiB, "
+                  f"{over_budget} prompts over budget, {per_turn * 1e6:.0f} us/turn, "
+                  f"previous prompt reused as prefix {reuse:.0%}")
+
+
+if __name__ == "__main__":
+    main()
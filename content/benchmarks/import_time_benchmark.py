@@ -0,0 +1,101 @@
+"""Cold start import time of the backend and RAG Lambda handlers.
+
+Every measurement runs in a fresh interpreter, like a Lambda cold start. The script
+reports the median time to import each handler module, the packages it imports
+with the largest cumulative import time from `python -X importtime`, and what each module
+a handler could defer to the first request would still cost once langchain.chains,
+which every request needs, is loaded. It exits with status 1 if a handler import
+exceeds the budget.
+
+Requires the lab requirements, no AWS account:
+
+    python benchmarks/import_time_benchmark.py --budget 4
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+from stubs import BACKEND_APP_DIR, RAG_APP_DIR
+
+HANDLERS = [
+    (BACKEND_APP_DIR, "backend_app"),
+    (RAG_APP_DIR, "rag_app"),
+]
+# Modules a request may not need, measured on top of langchain.chains
+DEFERRABLE = [
+    (BACKEND_APP_DIR, "langchain.llms.bedrock"),
+    (BACKEND_APP_DIR, "langchain.llms.sagemaker_endpoint"),
+    (BACKEND_APP_DIR, "langchain.embeddings"),
+    (BACKEND_APP_DIR, "chat_history"),
+    (BACKEND_APP_DIR, "streaming"),
+    (RAG_APP_DIR, "condense"),
+    (RAG_APP_DIR, "kendra.kendra_index_retriever"),
+    (RAG_APP_DIR, "kendra.kendra_fanout_retriever"),
+]
+ENV = {**os.environ, "AWS_REGION": "us-east-1", "REGION": "us-east-1", "AWS_DEFAULT_REGION": "us-east-1"}
+
+
+def import_time(directory, module, preload="", runs=5):
+    """Median seconds to import a module in a fresh interpreter, after importing preload."""
+    code = (
+        "import sys, time\n"
+        f"sys.path.insert(0, {directory!r})\n"
+        f"{'import ' + preload if preload else ''}\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    times = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=ENV, check=True)
+        times.append(float(result.stdout.strip()))
+    return statistics.median(times)
+
+
+def top_packages(directory, module, count=8):
+    """Packages imported by a module with the largest cumulative import time, from -X importtime."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {directory!r}); import {module}"],
+        capture_output=True, text=True, env=ENV, check=True
+    )
+    totals = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Each nesting level indents the name by two spaces, keep the imports made by the module itself
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            package = name.strip().split(".")[0]
+            totals[package] = totals.get(package, 0) + int(cumulative) / 1e6
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=4.0, help="Maximum seconds to import a handler")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per measurement")
+    args = parser.parse_args()
+
+    over_budget = False
+    for directory, module in HANDLERS:
+        seconds = import_time(directory, module, runs=args.runs)
+        over_budget |= seconds > args.budget
+        print(f"import {module}: {seconds:.2f} s (budget {args.budget:.2f} s)")
+        for package, package_seconds in top_packages(directory, module):
+            print(f"    {package:<20} {package_seconds:.2f} s")
+
+    print(f"import langchain.chains alone: {import_time(BACKEND_APP_DIR, 'langchain.chains', runs=args.runs):.2f} s")
+    print("Cost of deferrable modules, alone / after langchain.chains:")
+    for directory, module in DEFERRABLE:
+        alone = import_time(directory, module, runs=args.runs)
+        after = import_time(directory, module, preload="langchain.chains", runs=args.runs)
+        print(f"    {module:<35} {alone:.3f} s / {after:.3f} s")
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Response size, parse time and pack time of Kendra results, original kendra_query vs PageSize=k.
+
+The Kendra responses are read from kendra_responses/, a default page of 10 results
+per question of the Query and the Retrieve API. The checked in files follow the
+documented response format of both APIs, with passages of the AWS documentation,
+and were not captured from a live index. Replace them with responses of your own
+index with --record, which needs AWS credentials and kendra:Query / kendra:Retrieve.
+
+The original kendra_query requested the default page and built the Documents
+through an intermediate dict. With PageSize=k Kendra returns the first k results
+of the same ranking, so the PageSize=k responses are the recorded pages cut to k.
+Parse time is json.loads of the response body, as botocore does, and building the
+Documents, best of RUNS. Network latency is not included, it does not depend on
+the code and dominates every query. Pack time is pack_documents with the default
+RAG app budget.
+
+Requires the lab-02 RAG app requirements, no AWS account unless recording:
+
+    python benchmarks/kendra_query_benchmark.py
+    python benchmarks/kendra_query_benchmark.py --record <index id> --region us-east-1
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+from stubs import RAG_APP_DIR, add_to_path
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+add_to_path(RAG_APP_DIR)
+from langchain.docstore.document import Document  # noqa: E402
+from kendra.kendra_index_retriever import KendraIndexRetriever  # noqa: E402
+from kendra.kendra_results import _to_documents, estimate_tokens, pack_documents  # noqa: E402
+
+RESPONSES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kendra_responses")
+APIS = ("query", "retrieve")
+K = 3
+# CONTEXT_TOKEN_BUDGET of the RAG app, half of LLM_CONTEXT_LENGTH
+TOKEN_BUDGET = 1024
+RUNS = 200
+
+
+def load_responses(api):
+    with open(os.path.join(RESPONSES_DIR, f"{api}.json")) as f:
+        return json.load(f)
+
+
+def record(index_id, region):
+    import boto3
+
+    kclient = boto3.client("kendra", region_name=region)
+    for api in APIS:
+        call = kclient.retrieve if api == "retrieve" else kclient.query
+        responses = {}
+        for question in load_responses(api):
+            response = call(IndexId=index_id, QueryText=question)
+            response.pop("ResponseMetadata", None)
+            responses[question] = response
+        with open(os.path.join(RESPONSES_DIR, f"{api}.json"), "w") as f:
+            json.dump(responses, f, indent=1, ensure_ascii=False, default=str)
+            f.write("\n")
+        print(f"Recorded {len(responses)} {api} responses of index {index_id}")
+
+
+def original_kendra_query(response, kcount):
+    """Documents of kendra_query as it was before PageSize=k, from a parsed Query response."""
+    docs = []
+    for r in response["ResultItems"][:kcount]:
+        doc_title = r["DocumentTitle"]["Text"]
+        if (r["AdditionalAttributes"] and r["AdditionalAttributes"][0]["Key"] == "AnswerText"):
+            res_text = r["AdditionalAttributes"][0]["Value"]["TextWithHighlightsValue"]["Text"]
+        else:
+            res_text = r["DocumentExcerpt"]["Text"]
+        doc_excerpt = re.sub(r"\s+", " ", res_text).replace("...", "")
+        docs.append({
+            "page_content": "Document Title: " + doc_title + "\nDocument Excerpt: \n" + doc_excerpt + "\n",
+            "metadata": {"source": r["DocumentURI"], "title": doc_title, "excerpt": doc_excerpt, "type": r["Type"]},
+        })
+    return [Document(page_content=d["page_content"], metadata=d["metadata"]) for d in docs]
+
+
+class RecordedKendra:
+    """Kendra client stand-in answering with the recorded pages cut to PageSize."""
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    def _response(self, api, QueryText, PageSize=10, **kwargs):
+        response = self.responses[api][QueryText]
+        return json.loads(json.dumps({**response, "ResultItems": response["ResultItems"][:PageSize]}))
+
+    def query(self, **kwargs):
+        return self._response("query", **kwargs)
+
+    def retrieve(self, **kwargs):
+        return self._response("retrieve", **kwargs)
+
+
+def best_time(fn, items):
+    """Best of RUNS time per item of fn, in microseconds."""
+    best = float("inf")
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        best = min(best, time.perf_counter() - start)
+    return best / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--record", metavar="INDEX_ID", help="Record the responses of a live Kendra index")
+    parser.add_argument("--region", help="AWS region of the Kendra index")
+    args = parser.parse_args()
+    if args.record:
+        record(args.record, args.region)
+
+    responses = {api: load_responses(api) for api in APIS}
+    questions = list(responses["query"])
+    full_bodies = [json.dumps(responses["query"][q]) for q in questions]
+    cases = [("original, Query, default page", "query", full_bodies, original_kendra_query)]
+    for api in APIS:
+        bodies = [json.dumps({**responses[api][q], "ResultItems": responses[api][q]["ResultItems"][:K]})
+                  for q in questions]
+        cases.append((f"PageSize={K}, {api.capitalize()}", api, bodies, lambda r, k, api=api: _to_documents(r, k, api)))
+
+    print(f"{len(questions)} questions, k={K}, token budget {TOKEN_BUDGET}, best of {RUNS} runs")
+    for name, api, bodies, to_documents in cases:
+        parse = best_time(lambda body: to_documents(json.loads(body), K), bodies)
+        docs = [to_documents(json.loads(body), K) for body in bodies]
+        pack = best_time(lambda d: pack_documents(d, TOKEN_BUDGET), docs)
+        size = sum(len(body.encode("utf-8")) for body in bodies) / len(bodies)
+        tokens = sum(estimate_tokens(d.page_content) for ds in docs for d in ds) / len(docs)
+        print(f"  {name:<30} {size / 1024:5.1f} KiB/response, parse {parse:6.1f} us, "
+              f"pack {pack:5.1f} us, {tokens:.0f} context tokens")
+
+    # Whole retriever call, with the LangChain callback manager, against a client without latency
+    kclient = RecordedKendra(responses)
+    for api in APIS:
+        retriever = KendraIndexRetriever(kendraindex="index", awsregion="us-east-1", k=K, cache=None, api=api)
+        retriever.kclient = kclient
+        print(f"  KendraIndexRetriever, {api:<9} {best_time(retriever.get_relevant_documents, questions):6.1f} us "
+              f"per get_relevant_documents, response round tripped through JSON")
+
+
+if __name__ == "__main__":
+    main()
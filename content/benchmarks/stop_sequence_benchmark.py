@@ -0,0 +1,91 @@
+"""Correctness and throughput of the stop sequence handling of the Gradio generate loop.
+
+The original loop checked every token against the stop strings and the end of
+the whole output after every token. StopSequenceMatcher holds back only a tail
+that could start a stop sequence. Random token splits check that the final text
+is the text before the first stop sequence, rstripped, and that no yield shows
+part of one. The throughput includes building the yielded messages, which
+ChatInterface needs in full.
+
+Requires gradio and boto3, no AWS account:
+
+    python benchmarks/stop_sequence_benchmark.py
+"""
+import os
+import random
+import time
+
+from stubs import NOTEBOOKS_DIR, add_to_path
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+add_to_path(NOTEBOOKS_DIR)
+from gradio_app import StopSequenceMatcher, parameters  # noqa: E402
+
+STOP = parameters["stop"]
+SPLITS = 20_000
+
+
+def original_loop(tokens):
+    """The generate loop as it was before StopSequenceMatcher."""
+    output = ""
+    for token in tokens:
+        if token in STOP:
+            break
+        output += token
+        for stop in STOP:
+            if output.endswith(stop):
+                output = output[:-len(stop)].rstrip()
+                yield output
+        yield output
+
+
+def matcher_loop(tokens):
+    """The generate loop with StopSequenceMatcher."""
+    matcher = StopSequenceMatcher(STOP)
+    output = ""
+    for token in tokens:
+        delta = matcher.feed(token)
+        if matcher.stopped:
+            output = (output + delta).rstrip()
+            break
+        if delta:
+            output += delta
+            yield output
+    else:
+        output += matcher.flush()
+    yield output
+
+
+def check_splits():
+    rnd = random.Random(1)
+    alphabet = ["a", " ", "U", "ser", ":", "\n", "#", "##", "User", "<|", "endoftext", "|>", " Us", "er:", "x"]
+    for _ in range(SPLITS):
+        tokens = [rnd.choice(alphabet) for _ in range(rnd.randint(0, 30))]
+        text = "".join(tokens)
+        cut = min([i for i in (text.find(stop) for stop in STOP) if i >= 0], default=None)
+        visible = text if cut is None else text[:cut]
+        yields = list(matcher_loop(tokens))
+        assert yields[-1] == (text if cut is None else visible.rstrip()), (tokens, yields[-1])
+        assert all(visible.startswith(y) for y in yields[:-1]), tokens
+    print(f"{SPLITS} random token splits: final text ends before the first stop, no partial stop shown")
+
+
+def main():
+    check_splits()
+    rnd = random.Random(2)
+    words = "the quick brown fox jumps over the lazy dog and Users run # no".split()
+    for count in (1000, 4000, 16000):
+        tokens = [" " + rnd.choice(words) for _ in range(count)]
+        results = []
+        for name, loop in (("original loop", original_loop), ("StopSequenceMatcher", matcher_loop)):
+            best = float("inf")
+            for _ in range(5):
+                start = time.perf_counter()
+                yielded = sum(len(output) for output in loop(tokens))
+                best = min(best, time.perf_counter() - start)
+            results.append(f"{name} {count / best / 1e6:.2f}M tok/s")
+        print(f"{count} stop-free tokens, {yielded / 1e6:.1f} MB yielded: " + ", ".join(results))
+
+
+if __name__ == "__main__":
+    main()
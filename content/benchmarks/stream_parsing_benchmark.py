@@ -0,0 +1,129 @@
+"""Throughput and memory of parsing SageMaker response streams into TGI token events.
+
+Synthetic TGI token events are split into PayloadParts of different sizes and
+parsed with the original LineIterator, which kept every byte of the response
+in a BytesIO, and with iter_sse_data of the Gradio app. Throughput is the best
+of interleaved runs, peak memory is measured with tracemalloc while draining
+the stream. The script also checks that the copy of LineIterator in the streaming.py
+of the labs splits the streams like the Gradio app, also without a final newline.
+
+Requires gradio, boto3 and the lab-01 backend requirements, no AWS account:
+
+    python benchmarks/stream_parsing_benchmark.py
+"""
+import io
+import json
+import os
+import random
+import time
+import tracemalloc
+from collections import deque
+
+from stubs import BACKEND_APP_DIR, NOTEBOOKS_DIR, add_to_path
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+add_to_path(NOTEBOOKS_DIR, BACKEND_APP_DIR)
+import streaming  # noqa: E402
+from gradio_app import LineIterator, iter_sse_data  # noqa: E402
+
+TOKENS = 8000
+RUNS = 30
+
+
+class OriginalLineIterator:
+    """LineIterator as it was before it kept only the partial last line."""
+
+    def __init__(self, stream):
+        self.byte_iterator = iter(stream)
+        self.buffer = io.BytesIO()
+        self.read_pos = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            self.buffer.seek(self.read_pos)
+            line = self.buffer.readline()
+            if line and line[-1] == ord("\n"):
+                self.read_pos += len(line)
+                return line[:-1]
+            chunk = next(self.byte_iterator)
+            if "PayloadPart" not in chunk:
+                continue
+            self.buffer.seek(0, io.SEEK_END)
+            self.buffer.write(chunk["PayloadPart"]["Bytes"])
+
+
+def original_events(parts):
+    return (json.loads(line[len(b"data:"):]) for line in OriginalLineIterator(parts) if line.startswith(b"data:"))
+
+
+def drain(events):
+    deque(events, maxlen=0)
+
+
+def stream(tokens_count, min_part, max_part, seed=0):
+    """Split token events into PayloadParts of min_part to max_part bytes, one event per part if None."""
+    events = [
+        b"data:" + json.dumps({"token": {"id": i, "text": f" tok{i}", "special": False, "logprob": -0.1}}).encode()
+        + b"\n\n"
+        for i in range(tokens_count)
+    ]
+    if min_part is None:
+        return [{"PayloadPart": {"Bytes": e}} for e in events]
+    rnd = random.Random(seed)
+    data = b"".join(events)
+    parts = []
+    i = 0
+    while i < len(data):
+        size = rnd.randint(min_part, max_part)
+        parts.append({"PayloadPart": {"Bytes": data[i:i + size]}})
+        i += size
+    return parts
+
+
+def peak_memory(parse, parts):
+    tracemalloc.start()
+    drain(parse(parts))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def check_lab_copy():
+    for parts in (stream(500, 1, 120), stream(500, None, None), stream(500, 256, 4096)):
+        # Drop the final newlines, the last line is returned at the end of the stream
+        parts[-1] = {"PayloadPart": {"Bytes": parts[-1]["PayloadPart"]["Bytes"].rstrip(b"\n")}}
+        assert list(streaming.LineIterator(parts)) == list(LineIterator(parts))
+        assert list(streaming.iter_tgi_tokens(parts)) == [e["token"]["text"] for e in iter_sse_data(parts)]
+    print("LineIterator of the labs splits the streams like the Gradio app")
+
+
+def main():
+    check_lab_copy()
+    parsers = {"original LineIterator": original_events, "iter_sse_data": iter_sse_data}
+    print(f"{TOKENS} token events, best of {RUNS} interleaved runs")
+    for label, parts in [
+        ("1-120 B parts", stream(TOKENS, 1, 120)),
+        ("one event per part", stream(TOKENS, None, None)),
+        ("256 B-4 KiB parts", stream(TOKENS, 256, 4096)),
+    ]:
+        assert list(original_events(parts)) == list(iter_sse_data(parts))
+        best = dict.fromkeys(parsers, float("inf"))
+        for _ in range(RUNS):
+            for name, parse in parsers.items():
+                start = time.perf_counter()
+                drain(parse(parts))
+                best[name] = min(best[name], time.perf_counter() - start)
+        print(f"  {label}: " + ", ".join(f"{name} {TOKENS / best[name]:,.0f} tok/s" for name in parsers))
+
+    print("Peak traced memory while draining the stream, 1-120 B parts")
+    for count in (2000, 8000, 32000):
+        parts = stream(count, 1, 120)
+        print(f"  {count} tokens: " + ", ".join(
+            f"{name} {peak_memory(parse, parts) / 1024:.1f} KiB" for name, parse in parsers.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""In-memory stand-ins for the AWS clients used by the benchmarks.
+
+The stand-ins implement only the calls the code under test makes, with the
+latencies passed to them, so that the benchmarks run without an AWS account.
+"""
+import io
+import itertools
+import os
+import sys
+import threading
+import time
+
+from botocore.exceptions import ClientError, WaiterError
+
+CONTENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_APP_DIR = os.path.join(CONTENT_DIR, "lab-01", "backend", "backend-app")
+RAG_APP_DIR = os.path.join(CONTENT_DIR, "lab-02", "orchestration", "rag-app")
+NOTEBOOKS_DIR = os.path.join(CONTENT_DIR, "notebooks")
+
+
+def add_to_path(*dirs):
+    """Make the modules of the given application directories importable."""
+    for d in dirs:
+        if d not in sys.path:
+            sys.path.insert(0, d)
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a list of numbers, nearest rank."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class FakeSQS:
+    """SQS queue stand-in with long polling, visibility timeouts and receive counts."""
+
+    def __init__(self, visibility_timeout=30):
+        self.visibility_timeout = visibility_timeout
+        self.messages = {}
+        self.receipts = itertools.count()
+        self.receive_calls = 0
+        self.cond = threading.Condition()
+
+    def send(self, body):
+        with self.cond:
+            self.messages[next(self.receipts)] = {
+                "Body": body, "visible_at": 0.0, "count": 0, "sent": time.time(),
+            }
+            self.cond.notify_all()
+
+    def _visible(self, now):
+        return [k for k, m in self.messages.items() if m["visible_at"] <= now]
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, AttributeNames=()):
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self.cond:
+            self.receive_calls += 1
+            while True:
+                now = time.monotonic()
+                visible = self._visible(now)
+                if visible or now >= deadline:
+                    break
+                # Wake up when a hidden message becomes visible again
+                hidden = [m["visible_at"] for m in self.messages.values() if m["visible_at"] > now]
+                self.cond.wait(min([deadline] + hidden) - now)
+            result = []
+            for key in visible[:MaxNumberOfMessages]:
+                m = self.messages[key]
+                m["count"] += 1
+                m["visible_at"] = now + self.visibility_timeout
+                result.append({
+                    "Body": m["Body"],
+                    "ReceiptHandle": key,
+                    "Attributes": {
+                        "SentTimestamp": str(int(m["sent"] * 1000)),
+                        "ApproximateReceiveCount": str(m["count"]),
+                    },
+                })
+            return {"Messages": result} if result else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        with self.cond:
+            self.messages.pop(ReceiptHandle, None)
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        with self.cond:
+            if ReceiptHandle in self.messages:
+                self.messages[ReceiptHandle]["visible_at"] = time.monotonic() + VisibilityTimeout
+                self.cond.notify_all()
+
+
+class _ObjectExistsWaiter:
+    def __init__(self, s3, delay, max_attempts):
+        self.s3 = s3
+        self.delay = delay
+        self.max_attempts = max_attempts
+
+    def wait(self, Bucket, Key):
+        for _ in range(self.max_attempts):
+            try:
+                self.s3.head_object(Bucket=Bucket, Key=Key)
+                return
+            except ClientError:
+                time.sleep(self.delay)
+        raise WaiterError("ObjectExists", "Max attempts exceeded", {})
+
+
+class FakeS3:
+    """S3 stand-in keeping the objects in memory, with a fixed latency per call."""
+
+    def __init__(self, latency=0.0, waiter_delay=5, waiter_max_attempts=20):
+        self.latency = latency
+        self.waiter_delay = waiter_delay
+        self.waiter_max_attempts = waiter_max_attempts
+        self.objects = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _call(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def exists(self, bucket, key):
+        with self.lock:
+            return (bucket, key) in self.objects
+
+    def put_object(self, Bucket, Key, Body=b"", **kwargs):
+        self._call()
+        with self.lock:
+            self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode("utf-8")
+        return {}
+
+    def head_object(self, Bucket, Key):
+        self._call()
+        if not self.exists(Bucket, Key):
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self._call()
+        with self.lock:
+            body = self.objects[(Bucket, Key)]
+        if Range:
+            start, end = (int(x) for x in Range.split("=")[1].split("-"))
+            body = body[start:end + 1]
+        return {"Body": io.BytesIO(body), "ContentLength": len(body)}
+
+    def get_waiter(self, name):
+        return _ObjectExistsWaiter(self, self.waiter_delay, self.waiter_max_attempts)
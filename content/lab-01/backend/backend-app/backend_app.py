@@ -1,64 +1,160 @@
-import boto3
 import json
 import os
 
 from langchain.chains import ConversationChain
 from langchain.llms import SagemakerEndpoint
-from langchain.prompts import PromptTemplate
-from langchain.llms.sagemaker_endpoint import ContentHandlerBase, LLMContentHandler
-from langchain.chains.conversation.memory import ConversationBufferWindowMemory
 from langchain.llms.bedrock import Bedrock
-from langchain.memory.chat_message_histories import DynamoDBChatMessageHistory
-from llm.sagemaker_async_endpoint import *
+from langchain.memory import ConversationBufferWindowMemory
+from chat_history import MemoryWriter, RollingSummaryMemory, WindowedDynamoDBChatMessageHistory
+from resource_registry import registry
+from response_cache import ResponseCache, run_cached, stream_cached
+from sagemaker_content_handler import content_handler
+from streaming import StreamingBedrock, StreamingSagemakerEndpoint, TokenQueueCallbackHandler, stream_tokens
 
 REGION = os.environ.get('AWS_REGION', os.environ.get('AWS_DEFAULT_REGION'))
 SM_ENDPOINT_NAME = os.environ.get('SM_ENDPOINT_NAME')
 LLM_CONTEXT_LENGTH = os.environ.get('LLM_CONTEXT_LENGTH', '2048')
 BEDROCK_MODEL_ID = os.environ.get('BEDROCK_MODEL_ID', 'anthropic.claude-instant-v1')
+# "summary" keeps a rolling summary and the last CHAT_SUMMARY_TURNS turns within CHAT_MEMORY_TOKENS,
+# "window" replays the last CHAT_WINDOW_SIZE turns
+CHAT_MEMORY_MODE = os.environ.get('CHAT_MEMORY_MODE', 'window')
+CHAT_SUMMARY_TURNS = os.environ.get('CHAT_SUMMARY_TURNS', '2')
+CHAT_MEMORY_TOKENS = os.environ.get('CHAT_MEMORY_TOKENS', '')
 CHAT_WINDOW_SIZE = os.environ.get('CHAT_WINDOW_SIZE', '5')
 LLM_MEMORY_TABLE = os.environ.get('LLM_MEMORY_TABLE', 'LLMChatMemoryTable')
-
-# Content Handler for Falcon40b-instruct
-class ContentHandler(LLMContentHandler):
-    content_type = "application/json"
-    accepts = "application/json"
-
-    def transform_input(self, prompt, model_kwargs):
-        input_str = json.dumps(
-            {
-                "inputs": prompt,
-                "parameters":
-                {
-                    "do_sample": False,
-                    "repetition_penalty": 1.1,
-                    "return_full_text": False,
-                    "max_new_tokens": 1024
-                }
-            }
+# Write the chat history in the background. The stream function flushes it after the
+# last token, the REST handler flushes it before it returns, so there it only batches the writes
+CHAT_HISTORY_WRITE_BEHIND = os.environ.get('CHAT_HISTORY_WRITE_BEHIND', 'false')
+RESPONSE_CACHE_TABLE = os.environ.get('RESPONSE_CACHE_TABLE', '')
+RESPONSE_CACHE_TTL = os.environ.get('RESPONSE_CACHE_TTL', '3600')
+RESPONSE_CACHE_SIZE = os.environ.get('RESPONSE_CACHE_SIZE', '256')
+RESPONSE_CACHE_SIMILARITY = os.environ.get('RESPONSE_CACHE_SIMILARITY', '')
+BEDROCK_EMBEDDINGS_MODEL_ID = os.environ.get('BEDROCK_EMBEDDINGS_MODEL_ID', 'amazon.titan-embed-text-v1')
+
+def get_embeddings():
+    # Only needed for the similarity cache, importing the embeddings adds about 75 ms to a
+    # cold start (benchmarks/import_time_benchmark.py)
+    from langchain.embeddings import BedrockEmbeddings
+
+    return registry.get(
+        ("embeddings", "bedrock", BEDROCK_EMBEDDINGS_MODEL_ID, REGION),
+        lambda: BedrockEmbeddings(
+            client=registry.client('bedrock-runtime', REGION),
+            model_id=BEDROCK_EMBEDDINGS_MODEL_ID
         )
-        return input_str.encode('utf-8')
-
-    def transform_output(self, output):
-        response_json = json.loads(output.read().decode("utf-8"))
-        return response_json[0]["generated_text"]
-
-content_handler = ContentHandler()
-
-def get_llm(use_bedrock):
+    )
+
+# Answers to standalone questions are cached per container and, if RESPONSE_CACHE_TABLE is set, in DynamoDB.
+# Set RESPONSE_CACHE_SIMILARITY to a cosine similarity threshold, e.g. 0.95, to also match similar questions.
+response_cache = ResponseCache(
+    table_name=RESPONSE_CACHE_TABLE,
+    region_name=REGION,
+    ttl=int(RESPONSE_CACHE_TTL),
+    max_size=int(RESPONSE_CACHE_SIZE),
+    embed=(lambda text: get_embeddings().embed_query(text)) if RESPONSE_CACHE_SIMILARITY else None,
+    similarity_threshold=float(RESPONSE_CACHE_SIMILARITY or 0.95),
+)
+
+def get_cache_namespace(use_bedrock):
+    # Keep the answers of different backends, models apart
+    namespace = f"bedrock:{BEDROCK_MODEL_ID}" if use_bedrock else f"sagemaker:{SM_ENDPOINT_NAME}"
+    return namespace
+
+def get_llm(use_bedrock, streaming=False):
+    # LLM instances are cached per container and reused across warm invocations
     if use_bedrock:
-        llm = Bedrock(client=boto3.client(service_name='bedrock-runtime'),
-                    model_id=BEDROCK_MODEL_ID
+        llm_class = StreamingBedrock if streaming else Bedrock
+        llm = registry.get(
+            ("llm", "bedrock", BEDROCK_MODEL_ID, REGION, streaming),
+            lambda: llm_class(
+                client=registry.client('bedrock-runtime', REGION),
+                model_id=BEDROCK_MODEL_ID
+            )
         )
     else:
         # SageMaker langchain integration, to assist invoking SageMaker endpoint.
-        llm = SagemakerEndpoint(
-            endpoint_name=SM_ENDPOINT_NAME,
-            region_name=REGION,
-            # model_kwargs={}
-            content_handler=content_handler,
+        llm_class = StreamingSagemakerEndpoint if streaming else SagemakerEndpoint
+        llm = registry.get(
+            ("llm", "sagemaker", SM_ENDPOINT_NAME, REGION, streaming),
+            lambda: llm_class(
+                endpoint_name=SM_ENDPOINT_NAME,
+                region_name=REGION,
+                # model_kwargs={}
+                content_handler=content_handler,
+            )
         )
     return llm
 
+def get_memory_writer():
+    return registry.get(("memory_writer", REGION), lambda: MemoryWriter(registry.client('dynamodb', REGION)))
+
+def flush_chat_history():
+    # Lambda freezes the container once the response is sent, so the history is written before.
+    # The rolling summary is not waited for, it is updated in parallel with the next request
+    if CHAT_HISTORY_WRITE_BEHIND == 'true' and not get_memory_writer().flush():
+        print("Chat history not written yet, kept for the next request")
+
+def get_memory(session_id, summary_llm, memory_key="history"):
+    writer = get_memory_writer() if CHAT_HISTORY_WRITE_BEHIND == 'true' else None
+    if CHAT_MEMORY_MODE == 'summary':
+        turns = int(CHAT_SUMMARY_TURNS)
+        # A few more turns than kept verbatim are read, in case the last summary update is still running
+        message_history = WindowedDynamoDBChatMessageHistory(
+            table_name=LLM_MEMORY_TABLE,
+            session_id=session_id,
+            max_messages=2 * (turns + 3),
+            region_name=REGION,
+            writer=writer
+        )
+        return RollingSummaryMemory(
+            llm=summary_llm,
+            memory_key=memory_key,
+            chat_memory=message_history,
+            return_messages=True,
+            k=turns,
+            max_token_limit=int(CHAT_MEMORY_TOKENS or int(LLM_CONTEXT_LENGTH) // 4)
+        )
+
+    # Only the messages of the last CHAT_WINDOW_SIZE turns are read from DynamoDB
+    message_history = WindowedDynamoDBChatMessageHistory(
+        table_name=LLM_MEMORY_TABLE,
+        session_id=session_id,
+        max_messages=2 * int(CHAT_WINDOW_SIZE),
+        region_name=REGION,
+        writer=writer
+    )
+    return ConversationBufferWindowMemory(
+        memory_key=memory_key,
+        chat_memory=message_history,
+        return_messages=True,
+        k=int(CHAT_WINDOW_SIZE)
+    )
+
+def get_chain(llm, session_id):
+    memory = get_memory(session_id, llm)
+
+    chain = ConversationChain(
+        llm=llm,
+        verbose=True,
+        memory=memory,
+    )
+    return chain
+
+def stream_response(body):
+    """Run the conversation chain for a request body and yield the tokens as the LLM generates them.
+    Used by stream_server.py behind a Lambda function URL with response streaming."""
+    use_bedrock = body.get('USE_BEDROCK')
+    llm = get_llm(use_bedrock, streaming=True)
+    chain = get_chain(llm, body['uuid'])
+    handler = TokenQueueCallbackHandler()
+    return stream_cached(
+        response_cache,
+        chain,
+        body['query'],
+        get_cache_namespace(use_bedrock),
+        lambda: stream_tokens(lambda: chain.run(body['query'], callbacks=[handler]), handler)
+    )
+
 def lambda_handler(event, context):
 
     try:
@@ -75,25 +171,10 @@ def lambda_handler(event, context):
         print(use_bedrock)
 
         llm = get_llm(use_bedrock)
+        chain = get_chain(llm, uuid)
 
-        message_history = DynamoDBChatMessageHistory(
-            table_name=LLM_MEMORY_TABLE,
-            session_id=uuid
-        )
-
-        memory = ConversationBufferWindowMemory(
-            chat_memory=message_history,
-            return_messages=True,
-            k=int(CHAT_WINDOW_SIZE),
-        )
-
-        chain = ConversationChain(
-            llm=llm,
-            verbose=True,
-            memory=memory,
-        )
-
-        response = chain.run(query)
+        response = run_cached(response_cache, chain, query, get_cache_namespace(use_bedrock))
+        print(registry.stats())
         clean_response = response.replace('\n','').strip()
         status_code = 200
         print(clean_response)
@@ -101,6 +182,7 @@ def lambda_handler(event, context):
         print(e)
         status_code = 500
         clean_response = e
+    flush_chat_history()
     return {
         'statusCode': status_code,
         'body': json.dumps(f'{clean_response}')
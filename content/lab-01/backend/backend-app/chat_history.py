@@ -0,0 +1,426 @@
+import json
+import math
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+from langchain.chains.llm import LLMChain
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain.schema import (
+    BaseChatMessageHistory,
+    BaseMessage,
+    SystemMessage,
+    _message_to_dict,
+    get_buffer_string,
+    messages_from_dict,
+)
+
+from resource_registry import registry
+
+# MessageTime of the session record holding the rolling summary, messages have larger sort keys
+SUMMARY_TIME = 0
+
+# Summaries are updated one at a time, off the critical path of the requests, at most one
+# pending update per session
+_summary_executor = ThreadPoolExecutor(max_workers=1)
+_pending_summaries: Dict[Tuple[str, str], Any] = {}
+_pending_summaries_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of English text, about 4 characters per token."""
+    return math.ceil(len(text) / 4)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut the text at a word boundary so that it fits max_tokens."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    cut = text[:max_tokens * 4]
+    # Drop the word the cut went through, unless the text is a single word
+    if not cut[-1:].isspace() and not text[len(cut)].isspace() and len(cut.split()) > 1:
+        cut = cut.rsplit(None, 1)[0]
+    return cut.rstrip()
+
+
+def _submit_summary(key: Tuple[str, str], fn: Any) -> None:
+    """Run fn in the background unless an update of the session key is pending."""
+    with _pending_summaries_lock:
+        if key in _pending_summaries:
+            return
+        future = _pending_summaries[key] = _summary_executor.submit(fn)
+
+    def done(f: Any) -> None:
+        with _pending_summaries_lock:
+            if _pending_summaries.get(key) is f:
+                del _pending_summaries[key]
+    future.add_done_callback(done)
+
+
+def wait_for_summaries(timeout: Optional[float] = None) -> bool:
+    """Wait until the background summary updates are stored, return False on timeout.
+
+    The handlers do not wait, Lambda resumes an update cut by the freeze of the
+    container at its next request and a failed update is started again by the next
+    turn of the session.
+    """
+    with _pending_summaries_lock:
+        pending = list(_pending_summaries.values())
+    return not wait(pending, timeout).not_done
+
+
+class MemoryWriter:
+    """Background writer of chat history items.
+
+    Messages submitted by write-behind histories are written by a single worker thread
+    with BatchWriteItem, up to 25 items per call, so the human and AI messages of a turn
+    usually go out in one request. The order of the messages of a session is kept by
+    their MessageTime sort keys, assigned when the messages are added.
+
+    Lambda freezes the container after the handler returns, call flush before that.
+    Items whose write fails are kept, still returned by pending_items, and written
+    again by the next flush, so a failed write does not drop turns of a warm container.
+    """
+
+    def __init__(self, ddb_client: Any, linger: float = 0.01, max_retries: int = 5) -> None:
+        """
+        Args:
+            ddb_client: boto3 DynamoDB client.
+            linger: Seconds to wait for more items before writing a batch.
+            max_retries: Number of retries of unprocessed items.
+        """
+        self.ddb_client = ddb_client
+        self.linger = linger
+        self.max_retries = max_retries
+        self._queue = queue.Queue()
+        self._pending: Dict[Tuple[str, str], List[dict]] = {}
+        self._failed: List[Tuple[str, dict]] = []
+        self._unfinished = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._thread = None
+
+    def submit(self, table_name: str, item: dict) -> None:
+        """Queue an item for writing."""
+        with self._lock:
+            self._pending.setdefault((table_name, item["SessionId"]["S"]), []).append(item)
+            self._unfinished += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._queue.put((table_name, item))
+
+    def pending_items(self, table_name: str, session_id: str) -> List[dict]:
+        """Return the queued items of a session that may not be written yet."""
+        with self._lock:
+            return list(self._pending.get((table_name, session_id), []))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all queued items are written and write the failed ones again.
+
+        Returns:
+            False on timeout or if items are still not written, they are kept for the next flush.
+        """
+        with self._idle:
+            if not self._idle.wait_for(lambda: self._unfinished == 0, timeout):
+                return False
+            failed, self._failed = self._failed, []
+        if not failed:
+            return True
+        try:
+            self._write(failed)
+        except Exception as e:
+            with self._lock:
+                self._failed = failed + self._failed
+            print(f"Chat history write of {len(failed)} items failed again, kept for the next flush: {e}")
+            return False
+        with self._lock:
+            self._remove_pending(failed)
+        return True
+
+    def _remove_pending(self, batch: List[Tuple[str, dict]]) -> None:
+        for table_name, item in batch:
+            items = self._pending[(table_name, item["SessionId"]["S"])]
+            items.remove(item)
+            if not items:
+                del self._pending[(table_name, item["SessionId"]["S"])]
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.linger
+            while len(batch) < 25:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+                written = True
+            except Exception as e:
+                print(f"Chat history write of {len(batch)} items failed, retried at the next flush: {e}")
+                written = False
+            with self._idle:
+                if written:
+                    self._remove_pending(batch)
+                else:
+                    self._failed.extend(batch)
+                self._unfinished -= len(batch)
+                if self._unfinished == 0:
+                    self._idle.notify_all()
+
+    def _write(self, batch: List[Tuple[str, dict]]) -> None:
+        requests = {}
+        for table_name, item in batch:
+            requests.setdefault(table_name, []).append({"PutRequest": {"Item": item}})
+        for attempt in range(self.max_retries + 1):
+            requests = self.ddb_client.batch_write_item(RequestItems=requests).get("UnprocessedItems")
+            if not requests:
+                return
+            time.sleep(0.05 * 2 ** attempt)
+        raise RuntimeError(f"{sum(len(r) for r in requests.values())} chat history items were not written")
+
+
+class WindowedDynamoDBChatMessageHistory(BaseChatMessageHistory):
+    """Chat message history storing every message as a separate DynamoDB item.
+
+    The table has the SessionId partition key and the MessageTime sort key, the
+    creation time of the message in nanoseconds. Reading the history queries only
+    the last max_messages items in reverse order and adding a message is a single
+    PutItem, so the cost of a turn does not grow with the length of the session
+    and a session is not limited by the 400 KB item size.
+
+    With a MemoryWriter the messages are written behind, in the background. The
+    rolling summary of RollingSummaryMemory is stored in the session record, the
+    item with the MessageTime SUMMARY_TIME.
+
+    Example:
+        .. code-block:: python
+
+            history = WindowedDynamoDBChatMessageHistory("MemoryTable", session_id, max_messages=10)
+            # against DynamoDB Local
+            history = WindowedDynamoDBChatMessageHistory(
+                "MemoryTable", session_id, endpoint_url="http://localhost:8000")
+    """
+
+    def __init__(
+        self,
+        table_name: str,
+        session_id: str,
+        max_messages: Optional[int] = None,
+        region_name: Optional[str] = None,
+        endpoint_url: Optional[str] = None,
+        ddb_client: Any = None,
+        writer: Optional[MemoryWriter] = None
+    ) -> None:
+        """
+        Args:
+            table_name: DynamoDB table with the SessionId partition key and the MessageTime sort key.
+            session_id: Id of the chat session.
+            max_messages: Number of most recent messages to read, all messages if None.
+            region_name: AWS region of the DynamoDB table.
+            endpoint_url: Endpoint of a local DynamoDB stand-in, e.g. DynamoDB Local or LocalStack.
+            ddb_client: boto3 DynamoDB client to use instead of the shared one.
+            writer: MemoryWriter to write the messages behind, synchronous PutItem calls if None.
+        """
+        if ddb_client is None:
+            if endpoint_url:
+                import boto3
+
+                ddb_client = boto3.client("dynamodb", region_name=region_name, endpoint_url=endpoint_url)
+            else:
+                ddb_client = registry.client("dynamodb", region_name)
+        self.ddb_client = ddb_client
+        self.table_name = table_name
+        self.session_id = session_id
+        self.max_messages = max_messages
+        self.writer = writer
+        self._last_time = 0
+        self._lock = threading.Lock()
+
+    def _next_time(self) -> int:
+        # Strictly increasing, so messages added in the same nanosecond keep their order
+        with self._lock:
+            self._last_time = max(time.time_ns(), self._last_time + 1)
+            return self._last_time
+
+    def _query(self, limit: Optional[int] = None, **kwargs: Any) -> List[dict]:
+        items = []
+        request = {
+            "TableName": self.table_name,
+            "KeyConditionExpression": "SessionId = :session_id AND MessageTime > :summary_time",
+            "ExpressionAttributeValues": {
+                ":session_id": {"S": self.session_id},
+                ":summary_time": {"N": str(SUMMARY_TIME)},
+            },
+            **kwargs,
+        }
+        if limit:
+            request["Limit"] = limit
+        while True:
+            response = self.ddb_client.query(**request)
+            items.extend(response.get("Items", []))
+            if "LastEvaluatedKey" not in response or (limit and len(items) >= limit):
+                return items[:limit] if limit else items
+            request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def timed_messages(self) -> List[Tuple[int, BaseMessage]]:
+        """Retrieve the last max_messages messages with their MessageTime, oldest first"""
+        if self.max_messages:
+            items = self._query(limit=self.max_messages, ScanIndexForward=False)
+            items.reverse()
+        else:
+            items = self._query()
+        if self.writer is not None:
+            # Messages of this container that are not written yet
+            stored = {item["MessageTime"]["N"] for item in items}
+            items += [item for item in self.writer.pending_items(self.table_name, self.session_id)
+                      if item["MessageTime"]["N"] not in stored]
+            items.sort(key=lambda item: int(item["MessageTime"]["N"]))
+            if self.max_messages:
+                items = items[-self.max_messages:]
+        messages = messages_from_dict([json.loads(item["Message"]["S"]) for item in items])
+        return [(int(item["MessageTime"]["N"]), message) for item, message in zip(items, messages)]
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore
+        """Retrieve the last max_messages messages, oldest first"""
+        return [message for _, message in self.timed_messages()]
+
+    def load_summary(self) -> Tuple[str, int]:
+        """Return the rolling summary and the MessageTime of the last summarized message"""
+        item = self.ddb_client.get_item(
+            TableName=self.table_name,
+            Key={"SessionId": {"S": self.session_id}, "MessageTime": {"N": str(SUMMARY_TIME)}},
+        ).get("Item")
+        if item is None:
+            return "", SUMMARY_TIME
+        return item["Summary"]["S"], int(item["SummarizedUntil"]["N"])
+
+    def save_summary(self, summary: str, summarized_until: int) -> None:
+        """Store the rolling summary unless a summary of later messages is stored already"""
+        try:
+            self.ddb_client.put_item(
+                TableName=self.table_name,
+                Item={
+                    "SessionId": {"S": self.session_id},
+                    "MessageTime": {"N": str(SUMMARY_TIME)},
+                    "Summary": {"S": summary},
+                    "SummarizedUntil": {"N": str(summarized_until)},
+                },
+                ConditionExpression="attribute_not_exists(SummarizedUntil) OR SummarizedUntil < :until",
+                ExpressionAttributeValues={":until": {"N": str(summarized_until)}},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+    def add_message(self, message: BaseMessage) -> None:
+        """Store the message as a new item"""
+        item = {
+            "SessionId": {"S": self.session_id},
+            "MessageTime": {"N": str(self._next_time())},
+            "Message": {"S": json.dumps(_message_to_dict(message))},
+        }
+        if self.writer is not None:
+            self.writer.submit(self.table_name, item)
+        else:
+            self.ddb_client.put_item(TableName=self.table_name, Item=item)
+
+    def clear(self) -> None:
+        """Delete all messages of the session"""
+        if self.writer is not None:
+            self.writer.flush()
+        keys = [
+            {"SessionId": item["SessionId"], "MessageTime": item["MessageTime"]}
+            for item in self._query(ProjectionExpression="SessionId, MessageTime")
+        ]
+        keys.append({"SessionId": {"S": self.session_id}, "MessageTime": {"N": str(SUMMARY_TIME)}})
+        # BatchWriteItem accepts at most 25 requests
+        for start in range(0, len(keys), 25):
+            requests = {self.table_name: [{"DeleteRequest": {"Key": key}} for key in keys[start:start + 25]]}
+            while requests:
+                requests = self.ddb_client.batch_write_item(RequestItems=requests).get("UnprocessedItems")
+
+
+class RollingSummaryMemory(BaseChatMemory):
+    """Chat memory with a rolling summary of the older turns and the last k turns verbatim.
+
+    When the memory of a request is loaded, the turns older than the last k that are
+    not summarized yet are folded into the summary by the llm in a background thread,
+    in parallel with the rest of the request, and the summary is stored in the session
+    record, see WindowedDynamoDBChatMessageHistory. No request waits for a summary:
+    turns that are not summarized yet are included verbatim, newest first, as long as
+    the summary and the turns fit max_token_limit, so the prompt stays bounded however
+    long the conversation is.
+
+    Example:
+        .. code-block:: python
+
+            memory = RollingSummaryMemory(llm=llm, chat_memory=history, k=2, max_token_limit=512)
+    """
+
+    llm: Any
+    """LLM writing the summary, should not stream to the request callbacks."""
+    human_prefix: str = "Human"
+    ai_prefix: str = "AI"
+    memory_key: str = "history"  #: :meta private:
+    k: int = 2
+    """Number of turns kept verbatim."""
+    max_token_limit: int = 512
+    """Maximum number of tokens of the summary and the verbatim turns."""
+
+    @property
+    def memory_variables(self) -> List[str]:
+        """:meta private:"""
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the summary and the most recent turns within the token budget and start
+        folding the older turns into the summary in the background."""
+        stored_summary, summarized_until = self.chat_memory.load_summary()
+        timed_messages = self.chat_memory.timed_messages()
+        older = [(t, m) for t, m in timed_messages[:max(len(timed_messages) - 2 * self.k, 0)] if t > summarized_until]
+        if older:
+            _submit_summary(
+                (self.chat_memory.table_name, self.chat_memory.session_id),
+                lambda: self._update_summary(stored_summary, older)
+            )
+        # The summary gets at most half of the budget
+        summary = truncate_to_tokens(stored_summary, self.max_token_limit // 2)
+        budget = self.max_token_limit - estimate_tokens(summary)
+        messages = []
+        for message_time, message in reversed(timed_messages):
+            if message_time <= summarized_until:
+                break
+            budget -= estimate_tokens(message.content)
+            if budget < 0:
+                break
+            messages.append(message)
+        messages.reverse()
+        # Do not start with the answer of a turn whose question did not fit
+        if len(messages) > 1 and messages[0].type == "ai":
+            messages.pop(0)
+        if summary:
+            messages.insert(0, SystemMessage(content=summary))
+
+        buffer: Any = messages
+        if not self.return_messages:
+            buffer = get_buffer_string(messages, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)
+        return {self.memory_key: buffer}
+
+    def _update_summary(self, summary: str, older: List[Tuple[int, BaseMessage]]) -> None:
+        try:
+            start = time.perf_counter()
+            new_summary = LLMChain(llm=self.llm, prompt=SUMMARY_PROMPT).predict(
+                summary=summary,
+                new_lines=get_buffer_string([m for _, m in older], human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)
+            )
+            self.chat_memory.save_summary(new_summary.strip(), older[-1][0])
+            print(f"Summarized {len(older)} messages in {time.perf_counter() - start:.3f}s")
+        except Exception as e:
+            print(f"Summary update failed: {e}")
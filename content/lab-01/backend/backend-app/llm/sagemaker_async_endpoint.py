@@ -1,9 +1,19 @@
-from abc import abstractmethod
-from typing import Any, List, Optional
-from langchain.callbacks.manager import CallbackManagerForLLMRun
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
 from langchain.llms.utils import enforce_stop_tokens
 from langchain.llms.sagemaker_endpoint import SagemakerEndpoint
+from langchain.schema import Generation, LLMResult
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import boto3
+import gzip
+import io
+import json
+import queue
+import threading
+import weakref
 import time
 import os
 import uuid
@@ -12,12 +22,787 @@ import logging
 from botocore.exceptions import WaiterError, ClientError
 
 
+def split_s3_url(s3_url: str) -> Tuple[str, str]:
+    """Split an s3://bucket/key URL into a (bucket, key) tuple."""
+    parts = s3_url.split("/")
+    return parts[2], "/".join(parts[3:])
+
+
+def s3_object_exists(s3_client: Any, bucket: str, key: str) -> bool:
+    """Check with a single HeadObject call if an S3 object exists."""
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class _StreamingBodyReader(io.RawIOBase):
+    """Raw file object over a botocore StreamingBody."""
+
+    def __init__(self, body: Any) -> None:
+        self.body = body
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        data = self.body.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self) -> None:
+        self.body.close()
+        super().close()
+
+
+class RangedS3Reader(io.RawIOBase):
+    """Raw file object over an S3 object downloaded with parallel ranged GETs.
+
+    Parts are fetched in order, at most max_workers ahead of the reader, so at most
+    max_workers * part_size bytes are buffered.
+    """
+
+    def __init__(
+        self,
+        s3_client: Any,
+        bucket: str,
+        key: str,
+        size: int,
+        part_size: int = 8 * 1024 * 1024,
+        max_workers: int = 4
+    ) -> None:
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._parts = deque()
+        self._next_start = 0
+        self._buffer = memoryview(b"")
+        self._prefetch()
+
+    def _get_range(self, start: int, end: int) -> bytes:
+        return self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end}")["Body"].read()
+
+    def _prefetch(self) -> None:
+        while len(self._parts) < self.max_workers and self._next_start < self.size:
+            end = min(self._next_start + self.part_size, self.size) - 1
+            self._parts.append(self._executor.submit(self._get_range, self._next_start, end))
+            self._next_start = end + 1
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        if not self._buffer:
+            if not self._parts:
+                return 0
+            self._buffer = memoryview(self._parts.popleft().result())
+            self._prefetch()
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        super().close()
+
+
+class _GzipOutput(gzip.GzipFile):
+    """GzipFile that also closes the compressed stream."""
+
+    def close(self) -> None:
+        fileobj = self.fileobj
+        super().close()
+        if fileobj is not None:
+            fileobj.close()
+
+
+def open_output(
+    response: Any,
+    s3_client: Any = None,
+    output_url: Optional[str] = None,
+    ranged_threshold: int = 64 * 1024 * 1024,
+    part_size: int = 8 * 1024 * 1024,
+    buffer_size: int = 64 * 1024,
+    stream_threshold: int = 64 * 1024 * 1024
+) -> io.BufferedIOBase:
+    """Open an inference output, streaming large outputs instead of loading the body at once.
+
+    Outputs up to stream_threshold are read at once into an io.BytesIO, which is
+    faster and, for a single generation, needs less memory than incremental parsing.
+    Larger outputs are streamed, downloaded with parallel ranged GETs if they are
+    larger than ranged_threshold and the S3 client and output URL are given.
+    Gzip-compressed outputs, by ContentEncoding or by their magic number, are
+    decompressed on the fly.
+    Args:
+        response: S3 get_object response of the output
+        s3_client: S3 client for the ranged GETs
+        output_url: S3 URL of the output
+        ranged_threshold: Minimum ContentLength in bytes to use ranged GETs
+        part_size: Size in bytes of the ranged GETs
+        buffer_size: Read buffer size in bytes
+        stream_threshold: ContentLength in bytes above which the output is streamed
+    Returns:
+        A binary file object with the (decompressed) output
+    """
+    size = response.get("ContentLength") or 0
+    if size <= stream_threshold:
+        body = response["Body"].read()
+        if response.get("ContentEncoding") != "gzip" and body[:2] != GZIP_MAGIC:
+            return io.BytesIO(body)
+        # The decompressed output can be much larger than the ContentLength, decompress it as a stream
+        return _GzipOutput(fileobj=io.BytesIO(body), mode="rb")
+    if s3_client is not None and output_url and size > ranged_threshold:
+        response["Body"].close()
+        bucket, key = split_s3_url(output_url)
+        raw = RangedS3Reader(s3_client, bucket, key, size, part_size)
+    else:
+        raw = _StreamingBodyReader(response["Body"])
+    stream = io.BufferedReader(raw, buffer_size=buffer_size)
+    if response.get("ContentEncoding") == "gzip" or stream.peek(2)[:2] == GZIP_MAGIC:
+        return _GzipOutput(fileobj=stream, mode="rb")
+    return stream
+
+
+def iter_json_array(stream: Any, chunk_size: int = 64 * 1024) -> Any:
+    """Yield the items of a top-level JSON array from a binary stream one at a time.
+    Only the text and the parsed form of the current item are held in memory.
+    Raises:
+        ValueError: If the stream does not contain a JSON array
+    """
+    decoder = json.JSONDecoder()
+    text = io.TextIOWrapper(stream, encoding="utf-8")
+    buffer = ""
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer):
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if eof or (end < len(buffer) and buffer[end] in " \t\r\n,]"):
+                    yield item
+                    pos = end
+                    continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+        elif eof:
+            raise ValueError("Unterminated JSON array")
+        # Reading at least as much as is buffered keeps re-parsing a large item linear
+        chunk = text.read(max(chunk_size, len(buffer) - pos))
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def read_generated_text(output: Any) -> str:
+    """Parse a Hugging Face TGI output, [{"generated_text": "..."}], from a binary stream.
+    A streamed output, see open_output, is parsed one item at a time."""
+    if isinstance(output, io.BytesIO):
+        return "".join(item["generated_text"] for item in json.loads(output.getvalue()))
+    return "".join(item["generated_text"] for item in iter_json_array(output))
+
+
+class CompletionNotifier(ABC):
+    """Base class for waiting on SageMaker asynchronous inference results."""
+
+    @abstractmethod
+    def wait(
+        self,
+        inference_id: Optional[str],
+        output_url: str,
+        failure_url: str,
+        s3_client: Any = None
+    ) -> Any:
+        """Block until the inference finished and return the S3 get_object response.
+        Args:
+            inference_id: InferenceId returned by invoke_endpoint_async
+            output_url: S3 URL of the expected output file
+            failure_url: S3 URL of the expected failure file
+            s3_client: S3 client to use
+        Raises:
+            Exception: If the inference failed
+        """
+
+    async def await_result(
+        self,
+        inference_id: Optional[str],
+        output_url: str,
+        failure_url: str,
+        s3_client: Any = None
+    ) -> Any:
+        """Asyncio version of wait(), runs the blocking wait in a worker thread by default."""
+        return await asyncio.to_thread(self.wait, inference_id, output_url, failure_url, s3_client)
+
+    def discard(self, inference_id: Optional[str]) -> None:
+        """Mark an inference whose result nobody waits for, e.g. the wake-up request."""
+
+    def wait_all(self, requests: List[Tuple[Optional[str], str, str]], s3_client: Any = None) -> List[Any]:
+        """Wait for a set of inferences at once.
+        Args:
+            requests: (inference_id, output_url, failure_url) tuples
+            s3_client: S3 client to use
+        Returns:
+            The get_object responses in the order of the requests, or the exception
+            raised for the requests that failed.
+        """
+        def wait_one(request):
+            try:
+                return self.wait(*request, s3_client)
+            except Exception as e:
+                return e
+
+        if not requests:
+            return []
+        with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+            return list(executor.map(wait_one, requests))
+
+
+class S3PollingNotifier(CompletionNotifier):
+    """Detect inference completion by polling the output location on S3."""
+    # Delay and attempts of the boto3 object_exists waiter
+    WAITER_DELAY = 5
+    WAITER_MAX_ATTEMPTS = 20
+
+    def __init__(self, max_retries: int = 25, retry_delay: int = 5) -> None:
+        """
+        Args:
+            max_retries: Maximum retries to check for output file
+            retry_delay: Seconds to wait between retries
+        """
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+    def wait(
+        self,
+        inference_id: Optional[str],
+        output_url: str,
+        failure_url: str,
+        s3_client: Any = None
+    ) -> Any:
+        s3_client = boto3.client("s3") if s3_client is None else s3_client
+        bucket, output_prefix = split_s3_url(output_url)
+        failure_prefix = split_s3_url(failure_url)[1]
+
+        tries = 0
+        while tries < self.max_retries:
+            try:
+                waiter = s3_client.get_waiter('object_exists')
+                waiter.wait(Bucket=bucket, Key=output_prefix)
+
+                return s3_client.get_object(Bucket=bucket, Key=output_prefix)
+
+            except WaiterError:
+                tries += 1
+                print(f"Output file not found yet, waiting {self.retry_delay} seconds...")
+                time.sleep(self.retry_delay)
+
+        # Output file still not available, check failure file
+        waiter = s3_client.get_waiter('object_exists')
+        waiter.wait(Bucket=bucket, Key=failure_prefix)
+
+        raise Exception("Inference failed while waiting for file to be generated.")
+
+    def wait_all(self, requests: List[Tuple[Optional[str], str, str]], s3_client: Any = None) -> List[Any]:
+        # Check all pending outputs in one polling loop instead of a waiter per request
+        s3_client = boto3.client("s3") if s3_client is None else s3_client
+        results = [None] * len(requests)
+        pending = list(range(len(requests)))
+        for _ in range(self.max_retries * self.WAITER_MAX_ATTEMPTS):
+            still_pending = []
+            for i in pending:
+                _, output_url, failure_url = requests[i]
+                bucket, output_prefix = split_s3_url(output_url)
+                failure_bucket, failure_prefix = split_s3_url(failure_url)
+                try:
+                    if s3_object_exists(s3_client, bucket, output_prefix):
+                        results[i] = s3_client.get_object(Bucket=bucket, Key=output_prefix)
+                    elif s3_object_exists(s3_client, failure_bucket, failure_prefix):
+                        results[i] = Exception("Inference failed while waiting for file to be generated.")
+                    else:
+                        still_pending.append(i)
+                except ClientError as e:
+                    results[i] = e
+            pending = still_pending
+            if not pending:
+                return results
+            time.sleep(self.WAITER_DELAY)
+
+        for i in pending:
+            results[i] = Exception("Inference failed while waiting for file to be generated.")
+        return results
+
+    async def await_result(
+        self,
+        inference_id: Optional[str],
+        output_url: str,
+        failure_url: str,
+        s3_client: Any = None
+    ) -> Any:
+        # Poll with single HeadObject calls and sleep on the event loop instead of
+        # blocking a thread in the boto3 waiter
+        s3_client = boto3.client("s3") if s3_client is None else s3_client
+        bucket, output_prefix = split_s3_url(output_url)
+        failure_bucket, failure_prefix = split_s3_url(failure_url)
+
+        for _ in range(self.max_retries * self.WAITER_MAX_ATTEMPTS):
+            if await asyncio.to_thread(s3_object_exists, s3_client, bucket, output_prefix):
+                return await asyncio.to_thread(s3_client.get_object, Bucket=bucket, Key=output_prefix)
+            if await asyncio.to_thread(s3_object_exists, s3_client, failure_bucket, failure_prefix):
+                raise Exception("Inference failed while waiting for file to be generated.")
+            await asyncio.sleep(self.WAITER_DELAY)
+
+        raise Exception("Inference failed while waiting for file to be generated.")
+
+
+class SQSNotifier(CompletionNotifier):
+    """Detect inference completion from the endpoint success/error notifications.
+
+    The asynchronous endpoint publishes an InferenceResult event to the SNS topics
+    configured in AsyncInferenceConfig.NotificationConfig. Subscribe an SQS queue to
+    both topics and pass the queue URL here. Any object implementing the SQS
+    receive_message/delete_message/change_message_visibility calls can stand in for
+    the SQS client, and notifications can also be pushed directly with notify().
+
+    Only one waiting thread long-polls the queue at a time, the other waiters are
+    woken up as soon as their notification arrives.
+
+    Notifications for discarded inferences, and notifications older than timeout
+    that no waiter can still expect, are deleted. Other notifications nobody in this
+    process waits for are hidden again for an exponentially growing delay, so that
+    the consumers sharing the queue do not receive them in a busy loop.
+    """
+    # Discarded inference ids remembered per process
+    MAX_DISCARDED = 1000
+
+    def __init__(
+        self,
+        queue_url: str = "",
+        sqs_client: Any = None,
+        wait_time_seconds: int = 20,
+        timeout: int = 900,
+        release_delay: int = 1,
+        max_release_delay: int = 16
+    ) -> None:
+        """
+        Args:
+            queue_url: URL of the SQS queue subscribed to the notification topics.
+            sqs_client: SQS client to use, created if not provided and queue_url is set.
+            wait_time_seconds: Long polling time for a single receive_message call.
+            timeout: Maximum seconds to wait for a notification.
+            release_delay: Seconds to hide a notification of another consumer after its first receive.
+            max_release_delay: Upper bound of the doubling delay for notifications received again.
+        """
+        self.queue_url = queue_url
+        if sqs_client is None and queue_url:
+            sqs_client = boto3.client("sqs")
+        self.sqs_client = sqs_client
+        self.wait_time_seconds = wait_time_seconds
+        self.timeout = timeout
+        self.release_delay = release_delay
+        self.max_release_delay = max_release_delay
+        self._results = {}
+        self._pending = set()
+        self._discarded = deque(maxlen=self.MAX_DISCARDED)
+        self._polling = False
+        self._cond = threading.Condition()
+        self._futures = {}
+
+    @staticmethod
+    def parse_notification(body: str) -> Dict:
+        """Parse a notification, unwrapping the SNS envelope if raw delivery is off."""
+        message = json.loads(body)
+        if message.get("Type") == "Notification" and "Message" in message:
+            message = json.loads(message["Message"])
+        return message
+
+    def notify(self, notification: Dict) -> bool:
+        """Record an InferenceResult notification and wake up its waiter.
+        Returns:
+            True if a caller of this process is waiting for the notification.
+        """
+        inference_id = notification.get("inferenceId")
+        with self._cond:
+            if inference_id not in self._pending:
+                return False
+            self._results[inference_id] = notification
+            self._cond.notify_all()
+            if inference_id in self._futures:
+                loop, future = self._futures[inference_id]
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+        return True
+
+    def discard(self, inference_id: Optional[str]) -> None:
+        if inference_id is not None:
+            with self._cond:
+                self._discarded.append(inference_id)
+
+    def _is_stale(self, notification: Dict, attributes: Dict) -> bool:
+        """Check if no waiter can expect the notification anymore."""
+        with self._cond:
+            if notification.get("inferenceId") in self._discarded:
+                return True
+        sent_at = attributes.get("SentTimestamp")
+        return sent_at is not None and time.time() - int(sent_at) / 1000 > self.timeout
+
+    def _receive(self, deadline: float) -> None:
+        wait_time = int(min(self.wait_time_seconds, max(deadline - time.monotonic(), 0)))
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=wait_time,
+            AttributeNames=["SentTimestamp", "ApproximateReceiveCount"],
+        )
+        for m in response.get("Messages", []):
+            notification = self.parse_notification(m["Body"])
+            attributes = m.get("Attributes", {})
+            if self.notify(notification) or self._is_stale(notification, attributes):
+                self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=m["ReceiptHandle"])
+                continue
+            # Not ours, release the message for the other consumers of the queue after a backoff delay
+            receive_count = int(attributes.get("ApproximateReceiveCount", 1))
+            self.sqs_client.change_message_visibility(
+                QueueUrl=self.queue_url,
+                ReceiptHandle=m["ReceiptHandle"],
+                VisibilityTimeout=min(self.release_delay * 2 ** min(receive_count - 1, 16), self.max_release_delay),
+            )
+
+    def wait(
+        self,
+        inference_id: Optional[str],
+        output_url: str,
+        failure_url: str,
+        s3_client: Any = None
+    ) -> Any:
+        if inference_id is None:
+            raise ValueError("SQSNotifier requires the InferenceId of the request.")
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            self._pending.add(inference_id)
+        try:
+            notification = None
+            while notification is None:
+                with self._cond:
+                    while inference_id not in self._results and (self._polling or self.sqs_client is None):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    if inference_id in self._results:
+                        notification = self._results.pop(inference_id)
+                        break
+                    if time.monotonic() >= deadline:
+                        raise Exception(f"Timed out waiting for inference {inference_id} notification.")
+                    self._polling = True
+                try:
+                    self._receive(deadline)
+                finally:
+                    with self._cond:
+                        self._polling = False
+                        self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._pending.discard(inference_id)
+                self._results.pop(inference_id, None)
+                if notification is None:
+                    self._discarded.append(inference_id)
+
+        return self._get_output(notification, output_url, s3_client)
+
+    async def await_result(
+        self,
+        inference_id: Optional[str],
+        output_url: str,
+        failure_url: str,
+        s3_client: Any = None
+    ) -> Any:
+        if inference_id is None:
+            raise ValueError("SQSNotifier requires the InferenceId of the request.")
+        deadline = time.monotonic() + self.timeout
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        notification = None
+        with self._cond:
+            self._pending.add(inference_id)
+            self._futures[inference_id] = (loop, future)
+        try:
+            while True:
+                with self._cond:
+                    if inference_id in self._results:
+                        notification = self._results.pop(inference_id)
+                        break
+                    poll = not self._polling and self.sqs_client is not None
+                    if poll:
+                        self._polling = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception(f"Timed out waiting for inference {inference_id} notification.")
+                if not poll:
+                    # Another waiter is polling the queue, it wakes us up via notify()
+                    await asyncio.wait([future], timeout=min(remaining, self.wait_time_seconds))
+                    continue
+                try:
+                    await asyncio.to_thread(self._receive, deadline)
+                finally:
+                    with self._cond:
+                        self._polling = False
+                        self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._pending.discard(inference_id)
+                self._results.pop(inference_id, None)
+                self._futures.pop(inference_id, None)
+                if notification is None:
+                    self._discarded.append(inference_id)
+
+        return await asyncio.to_thread(self._get_output, notification, output_url, s3_client)
+
+    def _get_output(self, notification: Dict, output_url: str, s3_client: Any = None) -> Any:
+        if notification.get("invocationStatus") != "Completed":
+            raise Exception(f"Inference failed: {notification.get('failureReason', 'unknown reason')}")
+
+        s3_client = boto3.client("s3") if s3_client is None else s3_client
+        location = notification.get("responseParameters", {}).get("outputLocation", output_url)
+        bucket, key = split_s3_url(location)
+        return s3_client.get_object(Bucket=bucket, Key=key)
+
+
+class EndpointStateCache:
+    """Cache of the asynchronous endpoint state shared by all connectors of the process.
+
+    The cache lives on module level, so a warm Lambda container keeps it across
+    invocations and calls DescribeEndpoint at most once per TTL. The state can also
+    be fed from outside, e.g. from invoke errors or from the HasBacklogWithoutCapacity
+    CloudWatch metric, with set() and observe_backlog().
+    """
+    RUNNING = "running"
+    SCALED_TO_ZERO = "scaled_to_zero"
+
+    def __init__(self) -> None:
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, endpoint_name: str) -> Optional[str]:
+        """Return the cached state or None if it is unknown or expired."""
+        with self._lock:
+            entry = self._entries.get(endpoint_name)
+            if entry is None or entry["expires_at"] < time.monotonic():
+                return None
+            return entry["state"]
+
+    def set(self, endpoint_name: str, state: str, ttl: int = 60) -> None:
+        """Store the endpoint state for ttl seconds.
+
+        A sent wake-up request is remembered only while the previous entry is valid,
+        so an endpoint that is still or again scaled to zero after the TTL is woken up again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            previous = self._entries.get(endpoint_name)
+            woken = (
+                previous is not None
+                and previous["expires_at"] >= now
+                and previous["state"] == state
+                and previous["woken"]
+            )
+            self._entries[endpoint_name] = {
+                "state": state,
+                "expires_at": now + ttl,
+                "woken": woken,
+            }
+
+    def invalidate(self, endpoint_name: str) -> None:
+        """Forget the endpoint state, the next call describes the endpoint again."""
+        with self._lock:
+            self._entries.pop(endpoint_name, None)
+
+    def observe_backlog(self, endpoint_name: str, has_backlog_without_capacity: bool, ttl: int = 60) -> None:
+        """Update the state from the HasBacklogWithoutCapacity metric or alarm."""
+        self.set(endpoint_name, self.SCALED_TO_ZERO if has_backlog_without_capacity else self.RUNNING, ttl)
+
+    def claim_wake_up(self, endpoint_name: str) -> bool:
+        """Return True only for the first caller that sees the endpoint scaled to zero."""
+        with self._lock:
+            entry = self._entries.get(endpoint_name)
+            if entry is None or entry["state"] != self.SCALED_TO_ZERO or entry["woken"]:
+                return False
+            entry["woken"] = True
+            return True
+
+
+endpoint_state_cache = EndpointStateCache()
+
+
+class S3ObjectReaper:
+    """Delete consumed request and response objects in the background.
+
+    A single worker thread collects the scheduled objects for up to linger seconds
+    and deletes them with DeleteObjects, up to 1000 keys per bucket and call. The
+    number of deleted objects and bytes is kept for report().
+    """
+
+    def __init__(self, s3_client: Any = None, linger: float = 1.0) -> None:
+        """
+        Args:
+            s3_client: S3 client to use
+            linger: Seconds to collect objects before deleting them
+        """
+        self.s3_client = boto3.client("s3") if s3_client is None else s3_client
+        self.linger = linger
+        self.deleted_objects = 0
+        self.deleted_bytes = 0
+        self.errors = 0
+        self._queue = queue.Queue()
+        self._unfinished = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._thread = None
+
+    def schedule(self, bucket: str, key: str, size: int = 0) -> None:
+        """Queue an object for deletion."""
+        with self._lock:
+            self._unfinished += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._queue.put((bucket, key, size))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all queued objects are deleted, return False on timeout."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._unfinished == 0, timeout)
+
+    def report(self) -> Dict[str, int]:
+        """Return the number of deleted objects and bytes and of failed deletions."""
+        with self._lock:
+            return {"objects": self.deleted_objects, "bytes": self.deleted_bytes, "errors": self.errors}
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.linger
+            while True:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            deleted_objects, deleted_bytes, errors = self._delete(batch)
+            with self._idle:
+                self.deleted_objects += deleted_objects
+                self.deleted_bytes += deleted_bytes
+                self.errors += errors
+                self._unfinished -= len(batch)
+                if self._unfinished == 0:
+                    self._idle.notify_all()
+
+    def _delete(self, batch: List[Tuple[str, str, int]]) -> Tuple[int, int, int]:
+        sizes = {}
+        for bucket, key, size in batch:
+            sizes.setdefault(bucket, {})[key] = size
+        deleted_objects = deleted_bytes = errors = 0
+        for bucket, keys in sizes.items():
+            key_list = list(keys)
+            for start in range(0, len(key_list), 1000):
+                chunk = key_list[start:start + 1000]
+                try:
+                    response = self.s3_client.delete_objects(
+                        Bucket=bucket,
+                        Delete={"Objects": [{"Key": key} for key in chunk], "Quiet": True}
+                    )
+                    failed = {error["Key"] for error in response.get("Errors", [])}
+                except Exception as e:
+                    logging.getLogger(__name__).warning("Deleting %d objects from %s failed: %s", len(chunk), bucket, e)
+                    failed = set(chunk)
+                errors += len(failed)
+                deleted_objects += len(chunk) - len(failed)
+                deleted_bytes += sum(keys[key] for key in chunk if key not in failed)
+        return deleted_objects, deleted_bytes, errors
+
+
+def install_lifecycle_rule(
+    s3_client: Any,
+    bucket: str,
+    prefix: str,
+    expiration_days: int = 1,
+    rule_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """Install or replace an S3 lifecycle rule expiring the objects under a prefix,
+    e.g. the input_prefix of an endpoint or the S3 output path of its async inference config.
+    Other lifecycle rules of the bucket are kept.
+    Args:
+        s3_client: S3 client to use
+        bucket: Bucket of the objects
+        prefix: Key prefix of the objects to expire
+        expiration_days: Days after creation when the objects expire
+        rule_id: ID of the lifecycle rule, derived from the prefix if not provided
+    Returns:
+        The rule id, and the number and bytes of all objects under the prefix and of those
+        older than expiration_days that the rule will reclaim
+    """
+    rule_id = rule_id or f"expire-{prefix.strip('/').replace('/', '-')}"[:255]
+    try:
+        rules = s3_client.get_bucket_lifecycle_configuration(Bucket=bucket)["Rules"]
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "NoSuchLifecycleConfiguration":
+            raise
+        rules = []
+    rules = [rule for rule in rules if rule.get("ID") != rule_id]
+    rules.append({
+        "ID": rule_id,
+        "Filter": {"Prefix": prefix},
+        "Status": "Enabled",
+        "Expiration": {"Days": expiration_days},
+        "AbortIncompleteMultipartUpload": {"DaysAfterInitiation": 1},
+    })
+    s3_client.put_bucket_lifecycle_configuration(Bucket=bucket, LifecycleConfiguration={"Rules": rules})
+
+    report = {"rule_id": rule_id, "objects": 0, "bytes": 0, "reclaimable_objects": 0, "reclaimable_bytes": 0}
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=expiration_days)
+    for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            report["objects"] += 1
+            report["bytes"] += obj["Size"]
+            if obj["LastModified"] < cutoff:
+                report["reclaimable_objects"] += 1
+                report["reclaimable_bytes"] += obj["Size"]
+    return report
+
+
 class SagemakerAsyncEndpoint(SagemakerEndpoint):
     input_bucket: str = ""
     input_prefix: str = ""
     max_request_timeout: int = 90
     s3_client: Any
     sm_client: Any
+    completion_notifier: Any = None
+    endpoint_state_ttl: int = 60
+    max_concurrent_requests: int = 100
+    async_semaphores: Any = None
+    compress_input: bool = False
+    ranged_get_threshold: int = 64 * 1024 * 1024
+    object_reaper: Any = None
         
     def wait_inference_file(
         self,
@@ -37,35 +822,21 @@ class SagemakerAsyncEndpoint(SagemakerEndpoint):
         Raises:
             Exception: If failure file exists    
         """
-        s3_client = boto3.client("s3") if s3_client is None else s3_client
-        bucket = output_url.split("/")[2]
-        output_prefix = "/".join(output_url.split("/")[3:])
-        failure_prefix = "/".join(failure_url.split("/")[3:])
-        
-        tries = 0
-        while tries < max_retries:
-            try:
-                waiter = s3_client.get_waiter('object_exists')
-                waiter.wait(Bucket=bucket, Key=output_prefix)
-                
-                return s3_client.get_object(Bucket=bucket, Key=output_prefix)
-                
-            except WaiterError:
-                tries += 1
-                print(f"Output file not found yet, waiting {retry_delay} seconds...")
-                time.sleep(retry_delay)
-
-        # Output file still not available, check failure file
-        waiter = s3_client.get_waiter('object_exists') 
-        waiter.wait(Bucket=bucket, Key=failure_prefix)
-        
-        raise Exception("Inference failed while waiting for file to be generated.")
+        notifier = S3PollingNotifier(max_retries=max_retries, retry_delay=retry_delay)
+        return notifier.wait(None, output_url, failure_url, s3_client)
 
     def __init__(
         self,
         input_bucket: str = "",
         input_prefix: str = "",
         max_request_timeout: int = 90,
+        completion_notifier: Optional[CompletionNotifier] = None,
+        endpoint_state_ttl: int = 60,
+        max_concurrent_requests: int = 100,
+        compress_input: bool = False,
+        ranged_get_threshold: int = 64 * 1024 * 1024,
+        cleanup_objects: bool = False,
+        object_reaper: Optional[S3ObjectReaper] = None,
         **kwargs
     ) -> None:
         """
@@ -74,6 +845,13 @@ class SagemakerAsyncEndpoint(SagemakerEndpoint):
             input_bucket: S3 bucket name where input files are stored.
             input_prefix: S3 prefix where input files are stored.
             max_request_timeout: Maximum timeout for the request in seconds - also used to validate if endpoint is in cold start.
+            completion_notifier: Strategy to wait for the inference result, S3PollingNotifier if not provided.
+            endpoint_state_ttl: Seconds to trust the cached endpoint state before describing the endpoint again.
+            max_concurrent_requests: Maximum number of in-flight invocations per event loop, and of parallel submissions in a batch.
+            compress_input: Upload the inputs gzip-compressed, the model container must decompress them.
+            ranged_get_threshold: Size in bytes above which outputs are streamed and downloaded with parallel ranged GETs.
+            cleanup_objects: Delete the input and output objects in the background once the output is read.
+            object_reaper: S3ObjectReaper deleting the objects, a new one if cleanup_objects is set and not provided.
             kwargs: Keyword arguments to pass to the SagemakerEndpoint class.
         Raises:
             ValueError: If the input_bucket or input_prefix arguments are not of type str,
@@ -87,6 +865,44 @@ class SagemakerAsyncEndpoint(SagemakerEndpoint):
         self.max_request_timeout = max_request_timeout
         self.s3_client = boto3.client("s3")
         self.sm_client = boto3.client("sagemaker")
+        self.completion_notifier = S3PollingNotifier() if completion_notifier is None else completion_notifier
+        self.endpoint_state_ttl = endpoint_state_ttl
+        self.max_concurrent_requests = max_concurrent_requests
+        self.async_semaphores = weakref.WeakKeyDictionary()
+        self.compress_input = compress_input
+        self.ranged_get_threshold = ranged_get_threshold
+        if object_reaper is None and cleanup_objects:
+            object_reaper = S3ObjectReaper(self.s3_client)
+        self.object_reaper = object_reaper
+
+    def _put_input(self, body: Any, request_key: str) -> int:
+        """Upload a request payload, gzip-compressed if compress_input is set, and return its size."""
+        body = body.encode("utf-8") if isinstance(body, str) else body
+        if not self.compress_input:
+            self.s3_client.put_object(Body=body, Bucket=self.input_bucket, Key=request_key)
+            return len(body)
+        body = gzip.compress(body)
+        self.s3_client.put_object(
+            Body=body,
+            Bucket=self.input_bucket,
+            Key=request_key,
+            ContentEncoding="gzip"
+        )
+        return len(body)
+
+    def _transform_output(self, response: Any, output_url: str) -> str:
+        """Pass the output to the content handler, outputs above ranged_get_threshold as a stream, see open_output."""
+        with open_output(response, self.s3_client, output_url, self.ranged_get_threshold,
+                         stream_threshold=self.ranged_get_threshold) as output:
+            return self.content_handler.transform_output(output)
+
+    def _cleanup(self, request_key: str, request_size: int, output_url: str, response: Any) -> None:
+        """Schedule the deletion of a consumed input and output if cleanup is enabled."""
+        if self.object_reaper is None:
+            return
+        self.object_reaper.schedule(self.input_bucket, request_key, request_size)
+        bucket, key = split_s3_url(output_url)
+        self.object_reaper.schedule(bucket, key, response.get("ContentLength") or 0)
 
     # Private method to invoke endpoint
     def _invoke_endpoint(
@@ -117,6 +933,50 @@ class SagemakerAsyncEndpoint(SagemakerEndpoint):
         )
         return response
         
+    def _ensure_endpoint_running(
+        self,
+        content_type: str,
+        accepts: str,
+        **kwargs
+    ) -> None:
+        """Verify that the endpoint has running instances, using the shared state cache.
+
+        The endpoint is described only if the cached state is unknown or expired.
+        If the endpoint is scaled to zero, the first caller sends an empty request to
+        "wake up" the endpoint.
+        Raises:
+            Exception: If the endpoint is scaled to zero.
+        """
+        logger = logging.getLogger(__name__)
+        state = endpoint_state_cache.get(self.endpoint_name)
+        if state is None:
+            response = self.sm_client.describe_endpoint(EndpointName=self.endpoint_name)
+            endpoint_is_running = response["ProductionVariants"][0]["CurrentInstanceCount"] > 0
+            state = EndpointStateCache.RUNNING if endpoint_is_running else EndpointStateCache.SCALED_TO_ZERO
+            endpoint_state_cache.set(self.endpoint_name, state, self.endpoint_state_ttl)
+
+        if state == EndpointStateCache.RUNNING:
+            logger.info("Endpoint is running! Proceeding to inference.")
+            return
+
+        if endpoint_state_cache.claim_wake_up(self.endpoint_name):
+            test_key = os.path.join(self.input_prefix, "test")
+            self.s3_client.put_object(Body=b"", Bucket=self.input_bucket, Key=test_key)
+            response = self._invoke_endpoint(test_key, content_type, accepts, **kwargs)
+            # Nobody waits for the result of the wake-up request
+            self.completion_notifier.discard(response.get("InferenceId"))
+        logger.error("The endpoint is not running. Please check back in approximately 10 minutes.")
+        raise Exception("The endpoint is not running. Please check back in approximately 10 minutes.")
+
+    def _new_request_key(self) -> str:
+        """Create a unique S3 key for a request payload."""
+        now = datetime.datetime.now()
+        timestamp = now.strftime("%Y%m%d%H%M%S")    # including timestamp to avoid collision in a multi-user scenario
+        return os.path.join(
+            self.input_prefix, 
+            f"request-{timestamp}-{str(uuid.uuid4())}"
+        )
+
     def _call(
         self,
         prompt: str,
@@ -144,46 +1004,200 @@ class SagemakerAsyncEndpoint(SagemakerEndpoint):
         content_type = self.content_handler.content_type
         accepts = self.content_handler.accepts
 
-        # Verify if the endpoint is running
-        logger = logging.getLogger(__name__)
-        response = self.sm_client.describe_endpoint(EndpointName=self.endpoint_name)
-        endpoint_is_running = response["ProductionVariants"][0]["CurrentInstanceCount"] > 0
-
-        # If the endpoint is not running, send an empty request to "wake up" the endpoint
-        test_data = b""
-        test_key = os.path.join(self.input_prefix, "test")
-        self.s3_client.put_object(Body=test_data, Bucket=self.input_bucket, Key=test_key)
-        if not endpoint_is_running:
+        self._ensure_endpoint_running(content_type, accepts, **_endpoint_kwargs)
+
+        # Send request to the async endpoint
+        request_key = self._new_request_key()
+        request_size = self._put_input(body, request_key)
+        try:
             response = self._invoke_endpoint(
-                test_key, 
+                request_key, 
                 content_type, 
                 accepts, 
                 **_endpoint_kwargs)
-            logger.error("The endpoint is not running. Please check back in approximately 10 minutes.")
-            raise Exception("The endpoint is not running. Please check back in approximately 10 minutes.")
-        else:
-            logger.info("Endpoint is running! Proceeding to inference.")
 
-        # Send request to the async endpoint
-        now = datetime.datetime.now()
-        timestamp = now.strftime("%Y%m%d%H%M%S")    # including timestamp to avoid collision in a multi-user scenario
-        request_key = os.path.join(
-            self.input_prefix, 
-            f"request-{timestamp}-{str(uuid.uuid4())}"
-        )
-        self.s3_client.put_object(Body=body, Bucket=self.input_bucket, Key=request_key)
-        response = self._invoke_endpoint(
-            request_key, 
-            content_type, 
-            accepts, 
-            **_endpoint_kwargs)
-
-        # Read the bytes of the file from S3 in output_url with Boto3
-        output_url = response["OutputLocation"]
-        failure_url = response["FailureLocation"]
-        response = self.wait_inference_file(output_url, failure_url, self.s3_client)
-        text = self.content_handler.transform_output(response["Body"])
+            # Read the bytes of the file from S3 in output_url with Boto3
+            output_url = response["OutputLocation"]
+            failure_url = response["FailureLocation"]
+            response = self.completion_notifier.wait(
+                response.get("InferenceId"),
+                output_url,
+                failure_url,
+                self.s3_client)
+        except Exception:
+            # The endpoint may have scaled in meanwhile, describe it again on the next call
+            endpoint_state_cache.invalidate(self.endpoint_name)
+            raise
+        text = self._transform_output(response, output_url)
+        self._cleanup(request_key, request_size, output_url, response)
         if stop is not None:
             text = enforce_stop_tokens(text, stop)
 
-        return text
\ No newline at end of file
+        return text
+
+    def _generate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> LLMResult:
+        """
+        Submit all prompts to the asynchronous endpoint before waiting for any of them.
+        The inputs are uploaded and the endpoint invoked in parallel, then the
+        completion notifier waits for all output locations together.
+        Args:
+            prompts: The prompts to use for the inference.
+            stop: The stop tokens to use for the inference.
+            run_manager: The run manager to use for the inference.
+            kwargs: Keyword arguments to pass to the SagemakerEndpoint class.
+        Returns:
+            The generations in the order of the prompts. Failed prompts have an empty
+            text and the error in generation_info["error"].
+        """
+        if len(prompts) == 1:
+            text = self._call(prompts[0], stop=stop, run_manager=run_manager, **kwargs)
+            return LLMResult(generations=[[Generation(text=text)]])
+
+        _model_kwargs = self.model_kwargs or {}
+        _model_kwargs = {**_model_kwargs, **kwargs}
+        _endpoint_kwargs = self.endpoint_kwargs or {}
+        content_type = self.content_handler.content_type
+        accepts = self.content_handler.accepts
+
+        self._ensure_endpoint_running(content_type, accepts, **_endpoint_kwargs)
+
+        def submit(prompt):
+            try:
+                body = self.content_handler.transform_input(prompt, _model_kwargs)
+                request_key = self._new_request_key()
+                request_size = self._put_input(body, request_key)
+                response = self._invoke_endpoint(request_key, content_type, accepts, **_endpoint_kwargs)
+                return (response.get("InferenceId"), response["OutputLocation"], response["FailureLocation"],
+                        request_key, request_size)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=min(len(prompts), self.max_concurrent_requests)) as executor:
+            submitted = list(executor.map(submit, prompts))
+
+        requests = [r[:3] for r in submitted if not isinstance(r, Exception)]
+        responses = iter(self.completion_notifier.wait_all(requests, self.s3_client))
+
+        texts = []
+        for r in submitted:
+            response = r if isinstance(r, Exception) else next(responses)
+            if isinstance(response, Exception):
+                texts.append(response)
+                continue
+            try:
+                text = self._transform_output(response, r[1])
+                self._cleanup(r[3], r[4], r[1], response)
+                texts.append(enforce_stop_tokens(text, stop) if stop is not None else text)
+            except Exception as e:
+                texts.append(e)
+
+        if any(isinstance(t, Exception) for t in texts):
+            endpoint_state_cache.invalidate(self.endpoint_name)
+        return self._batch_result(texts)
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """Return the semaphore limiting in-flight invocations on the running event loop."""
+        loop = asyncio.get_running_loop()
+        semaphore = self.async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+            self.async_semaphores[loop] = semaphore
+        return semaphore
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> str:
+        """
+        Call out to Sagemaker asynchronous inference endpoint without blocking the event loop.
+        The boto3 calls run in worker threads, the wait for the result sleeps on the event loop,
+        and at most max_concurrent_requests invocations are in flight at the same time.
+        Args:
+            prompt: The prompt to use for the inference.
+            stop: The stop tokens to use for the inference.
+            run_manager: The run manager to use for the inference.
+            kwargs: Keyword arguments to pass to the SagemakerEndpoint class.
+        Returns:
+            The output from the Sagemaker asynchronous inference endpoint.
+        """
+        _model_kwargs = self.model_kwargs or {}
+        _model_kwargs = {**_model_kwargs, **kwargs}
+        _endpoint_kwargs = self.endpoint_kwargs or {}
+
+        body = self.content_handler.transform_input(prompt, _model_kwargs)
+        content_type = self.content_handler.content_type
+        accepts = self.content_handler.accepts
+
+        async with self._get_semaphore():
+            await asyncio.to_thread(self._ensure_endpoint_running, content_type, accepts, **_endpoint_kwargs)
+
+            request_key = self._new_request_key()
+            request_size = await asyncio.to_thread(self._put_input, body, request_key)
+            try:
+                response = await asyncio.to_thread(
+                    self._invoke_endpoint,
+                    request_key,
+                    content_type,
+                    accepts,
+                    **_endpoint_kwargs)
+                output_url = response["OutputLocation"]
+                response = await self.completion_notifier.await_result(
+                    response.get("InferenceId"),
+                    output_url,
+                    response["FailureLocation"],
+                    self.s3_client)
+            except Exception:
+                endpoint_state_cache.invalidate(self.endpoint_name)
+                raise
+            # Reading and parsing the streamed output blocks, keep it off the event loop
+            text = await asyncio.to_thread(self._transform_output, response, output_url)
+            self._cleanup(request_key, request_size, output_url, response)
+
+        if stop is not None:
+            text = enforce_stop_tokens(text, stop)
+
+        return text
+
+    async def _agenerate(
+        self,
+        prompts: List[str],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> LLMResult:
+        """Run the prompts concurrently, the base class awaits them one after another."""
+        if len(prompts) == 1:
+            text = await self._acall(prompts[0], stop=stop, run_manager=run_manager, **kwargs)
+            return LLMResult(generations=[[Generation(text=text)]])
+        texts = await asyncio.gather(
+            *[self._acall(prompt, stop=stop, run_manager=run_manager, **kwargs) for prompt in prompts],
+            return_exceptions=True
+        )
+        return self._batch_result(texts)
+
+    @staticmethod
+    def _batch_result(texts: List[Any]) -> LLMResult:
+        """Build an LLMResult from per-prompt texts or exceptions.
+        Failed prompts get an empty text with the error in generation_info["error"].
+        Raises:
+            Exception: The first error, if all prompts failed.
+        """
+        errors = [t for t in texts if isinstance(t, Exception)]
+        if errors and len(errors) == len(texts):
+            raise errors[0]
+        generations = []
+        for text in texts:
+            if isinstance(text, Exception):
+                generations.append([Generation(text="", generation_info={"error": str(text)})])
+            else:
+                generations.append([Generation(text=text)])
+        return LLMResult(generations=generations)
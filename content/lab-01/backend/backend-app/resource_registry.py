@@ -0,0 +1,56 @@
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import boto3
+
+
+class ResourceRegistry:
+    """Per-container registry of LLM instances and AWS clients.
+
+    Resources are built lazily on first use and kept on module level, so warm
+    Lambda invocations reuse them instead of constructing new clients per request.
+
+    Example:
+        .. code-block:: python
+
+            bedrock = registry.client("bedrock-runtime", "us-east-1")
+            llm = registry.get(("llm", "bedrock", model_id), lambda: Bedrock(...))
+    """
+
+    def __init__(self) -> None:
+        self._resources: Dict[Hashable, Any] = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Return the resource registered under key, build it with factory on first use."""
+        with self._lock:
+            if key in self._resources:
+                self.hits += 1
+                return self._resources[key]
+            self.misses += 1
+            resource = factory()
+            self._resources[key] = resource
+            return resource
+
+    def client(self, service_name: str, region_name: Optional[str] = None) -> Any:
+        """Return a shared boto3 client for the service and region."""
+        return self.get(
+            ("client", service_name, region_name),
+            lambda: boto3.client(service_name=service_name, region_name=region_name)
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the number of registered resources and the cache hit rate."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "resources": len(self._resources),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+registry = ResourceRegistry()
@@ -0,0 +1,4 @@
+#!/bin/bash
+
+# Entry point of the streaming function, started by the Lambda Web Adapter
+PYTHONPATH=$PYTHONPATH:/opt/python:$LAMBDA_RUNTIME_DIR exec python stream_server.py
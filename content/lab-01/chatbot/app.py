@@ -10,11 +10,42 @@ import sys
 import json
 import os
 import requests
+from http.cookiejar import DefaultCookiePolicy
 import uuid
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 AI_ICON = "app_icon.png"
 base_url = os.getenv('BASE_URL')
+stream_url = os.getenv('STREAM_URL')
 headers = {'Content-Type': 'application/json'}
+# Seconds to connect and to wait for the next bytes of the response
+connect_timeout = float(os.getenv('CONNECT_TIMEOUT', '5'))
+read_timeout = float(os.getenv('READ_TIMEOUT', '60'))
+request_retries = int(os.getenv('REQUEST_RETRIES', '2'))
+pool_size = int(os.getenv('HTTP_POOL_SIZE', '10'))
+
+# HTTP session shared by all reruns and users of the app, so the TCP and TLS connections
+# to the backend are kept alive between messages. The session id of a user is sent in the
+# request body, and the session accepts no cookies, so no state of one user reaches another
+@st.cache_resource
+def get_http_session():
+    # Only retry requests the backend did not process: connection errors and throttling
+    retry = Retry(
+        total=request_retries,
+        read=0,
+        status_forcelist=(429, 503),
+        allowed_methods=frozenset(["POST"]),
+        backoff_factor=0.5,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.headers.update(headers)
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 st.set_page_config(page_title="LLM-powered chatbot")
 
@@ -133,10 +164,29 @@ def generate_response(prompt):
     url = f'{base_url}/backendapp'
     use_bedrock = st.session_state['USE_BEDROCK']
     body = {"query": prompt, "uuid": session_id, "USE_BEDROCK": use_bedrock}
-    response = requests.post(url, headers=headers, data=json.dumps(body), verify=False)
+    if stream_url:
+        return stream_response(body)
+    response = get_http_session().post(url, data=json.dumps(body), verify=False,
+                                       timeout=(connect_timeout, read_timeout))
     output_text = response.text
     return output_text
 
+## Function rendering the tokens from the streaming backend as they arrive
+def stream_response(body):
+    placeholder = st.empty()
+    output_text = ""
+    with get_http_session().post(stream_url, data=json.dumps(body), stream=True,
+                                 timeout=(connect_timeout, read_timeout)) as response:
+        if not response.ok:
+            # Throttling or a failed invocation after the retries, the body is not an answer
+            return f"The chatbot backend failed with {response.status_code} {response.reason}, please try again."
+        response.encoding = 'utf-8'
+        for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+            output_text += chunk
+            placeholder.markdown(output_text + "▌")
+    placeholder.empty()
+    return output_text
+
 ## Conditional display of AI generated responses as a function of user provided prompts
 with response_container:
     if user_input:
@@ -0,0 +1,236 @@
+import asyncio
+import inspect
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain.callbacks.manager import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
+from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
+from langchain.schema import Document
+
+from kendra.kendra_results import pack_documents
+from response_cache import normalize_question
+
+# Words that usually point back to an earlier turn of the conversation
+_REFERENCE_WORDS = re.compile(
+    r"\b(it|its|they|them|their|this|that|these|those|he|she|him|her|his|hers|there|"
+    r"above|previous|former|latter|same|one|ones|else|more|other|another)\b",
+    re.IGNORECASE
+)
+# Openings of elliptical follow ups, e.g. "and for Bedrock?" or "what about pricing?"
+_FOLLOW_UP_OPENINGS = re.compile(
+    r"^\s*(and|or|but|also|so|then|what about|how about|why not|why|how come|same)\b",
+    re.IGNORECASE
+)
+
+
+def is_self_contained(question: str, min_words: int = 4) -> bool:
+    """Cheap check whether a follow up question can be used for retrieval without a rewrite."""
+    if len(question.split()) < min_words:
+        return False
+    return not _FOLLOW_UP_OPENINGS.search(question) and not _REFERENCE_WORDS.search(question)
+
+
+class FastCondenseConversationalRetrievalChain(ConversationalRetrievalChain):
+    """ConversationalRetrievalChain with a fast path for the condense question step.
+
+    - Without chat history the question is used as is.
+    - A self-contained follow up skips the condense LLM call.
+    - Otherwise the retriever runs speculatively on the raw question while the
+      condense LLM rewrites it. If the rewrite is ready within condense_timeout
+      and differs from the question, the documents are retrieved again for it,
+      else the speculative documents and the raw question are used.
+
+    The duration of every stage is printed after each call. With context_token_budget
+    the retrieved documents are de-duplicated and packed into the budget by score.
+    With a response_cache the answer is looked up by the standalone question, after
+    the condense step and before retrieval, so follow ups rewritten to a question
+    answered before also hit the cache.
+    """
+
+    condense_timeout: float = 5.0
+    """Seconds to wait for the rewritten question before falling back to the raw question."""
+    context_token_budget: Optional[int] = None
+    """Maximum number of tokens of the retrieved documents stuffed into the prompt."""
+    response_cache: Any = None
+    """ResponseCache of the answers to standalone questions, not used if None."""
+    cache_namespace: str = ""
+    """Namespace of the cached answers, e.g. backend, model and knowledge base."""
+
+    def _reduce_tokens_below_limit(self, docs: List[Document]) -> List[Document]:
+        if self.context_token_budget is None:
+            return super()._reduce_tokens_below_limit(docs)
+        packed, saved_tokens = pack_documents(docs, self.context_token_budget)
+        print(f"Context packing: kept {len(packed)} of {len(docs)} documents, saved about {saved_tokens} tokens")
+        return packed
+
+    def _condense_plan(self, question: str, chat_history_str: str) -> str:
+        if not chat_history_str:
+            return "no_history"
+        if is_self_contained(question):
+            return "self_contained"
+        return "rewrite"
+
+    def _timed_docs(
+        self, question: str, inputs: Dict[str, Any], run_manager: CallbackManagerForChainRun
+    ) -> Tuple[List[Document], float]:
+        start = time.perf_counter()
+        # Older langchain versions do not pass the run manager to _get_docs
+        if "run_manager" in inspect.signature(self._get_docs).parameters:
+            docs = self._get_docs(question, inputs, run_manager=run_manager)
+        else:
+            docs = self._get_docs(question, inputs)  # type: ignore[call-arg]
+        return docs, time.perf_counter() - start
+
+    async def _atimed_docs(
+        self, question: str, inputs: Dict[str, Any], run_manager: AsyncCallbackManagerForChainRun
+    ) -> Tuple[List[Document], float]:
+        start = time.perf_counter()
+        if "run_manager" in inspect.signature(self._aget_docs).parameters:
+            docs = await self._aget_docs(question, inputs, run_manager=run_manager)
+        else:
+            docs = await self._aget_docs(question, inputs)  # type: ignore[call-arg]
+        return docs, time.perf_counter() - start
+
+    def _cache_lookup(self, plan: str, new_question: str) -> Tuple[Optional[str], Any]:
+        # A follow up that was not rewritten is not a standalone question
+        if self.response_cache is None or plan == "rewrite_timeout":
+            return None, None
+        return self.response_cache.lookup(self.cache_namespace, new_question)
+
+    def _cache_store(self, plan: str, new_question: str, answer: str, embedding: Any) -> None:
+        if self.response_cache is not None and plan != "rewrite_timeout":
+            self.response_cache.store(self.cache_namespace, new_question, answer, embedding)
+
+    @staticmethod
+    def _answer_inputs(inputs: Dict[str, Any], new_question: str, chat_history_str: str) -> Dict[str, Any]:
+        new_inputs = inputs.copy()
+        new_inputs["question"] = new_question
+        new_inputs["chat_history"] = chat_history_str
+        return new_inputs
+
+    def _output(self, answer: str, docs: List[Document], new_question: str) -> Dict[str, Any]:
+        output: Dict[str, Any] = {self.output_key: answer}
+        if self.return_source_documents:
+            output["source_documents"] = docs
+        if self.return_generated_question:
+            output["generated_question"] = new_question
+        return output
+
+    def _call(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        timings = {}
+        start = time.perf_counter()
+        question = inputs["question"]
+        get_chat_history = self.get_chat_history or _get_chat_history
+        chat_history_str = get_chat_history(inputs["chat_history"])
+        plan = self._condense_plan(question, chat_history_str)
+
+        executor = speculative = None
+        try:
+            if plan == "rewrite":
+                executor = ThreadPoolExecutor(max_workers=2)
+                speculative = executor.submit(self._timed_docs, question, inputs, _run_manager)
+                rewrite = executor.submit(
+                    self.question_generator.run,
+                    question=question,
+                    chat_history=chat_history_str,
+                    callbacks=_run_manager.get_child()
+                )
+                try:
+                    new_question = rewrite.result(timeout=self.condense_timeout).strip() or question
+                except FutureTimeoutError:
+                    print(f"Condense question timed out after {self.condense_timeout}s, using the raw question")
+                    plan, new_question = "rewrite_timeout", question
+            else:
+                new_question = question
+            timings["condense"] = time.perf_counter() - start
+            cached_answer, embedding = self._cache_lookup(plan, new_question)
+            if cached_answer is not None:
+                print(f"Condense plan: {plan}, answered from the response cache in {time.perf_counter() - start:.3f}s")
+                return self._output(cached_answer, [], new_question)
+            if speculative is not None and normalize_question(new_question) == normalize_question(question):
+                docs, timings["retrieve"] = speculative.result()
+            else:
+                if speculative is not None:
+                    plan = "rewrite_retrieve"
+                docs, timings["retrieve"] = self._timed_docs(new_question, inputs, _run_manager)
+        finally:
+            if executor is not None:
+                # A late rewrite or an unused speculative retrieval is not waited for
+                executor.shutdown(wait=False)
+
+        answer_start = time.perf_counter()
+        answer = self.combine_docs_chain.run(
+            input_documents=docs,
+            callbacks=_run_manager.get_child(),
+            **self._answer_inputs(inputs, new_question, chat_history_str)
+        )
+        timings["answer"] = time.perf_counter() - answer_start
+        self._cache_store(plan, new_question, answer, embedding)
+        timings["total"] = time.perf_counter() - start
+        print(f"Condense plan: {plan}, stage timings (s): { {k: round(v, 3) for k, v in timings.items()} }")
+        return self._output(answer, docs, new_question)
+
+    async def _acall(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        _run_manager = run_manager or AsyncCallbackManagerForChainRun.get_noop_manager()
+        timings = {}
+        start = time.perf_counter()
+        question = inputs["question"]
+        get_chat_history = self.get_chat_history or _get_chat_history
+        chat_history_str = get_chat_history(inputs["chat_history"])
+        plan = self._condense_plan(question, chat_history_str)
+
+        speculative = None
+        if plan == "rewrite":
+            speculative = asyncio.ensure_future(self._atimed_docs(question, inputs, _run_manager))
+            rewrite = asyncio.ensure_future(self.question_generator.arun(
+                question=question,
+                chat_history=chat_history_str,
+                callbacks=_run_manager.get_child()
+            ))
+            try:
+                new_question = (await asyncio.wait_for(rewrite, self.condense_timeout)).strip() or question
+            except asyncio.TimeoutError:
+                print(f"Condense question timed out after {self.condense_timeout}s, using the raw question")
+                plan, new_question = "rewrite_timeout", question
+        else:
+            new_question = question
+        timings["condense"] = time.perf_counter() - start
+        # The cache tiers call DynamoDB and the embeddings model with blocking clients
+        cached_answer, embedding = await asyncio.to_thread(self._cache_lookup, plan, new_question)
+        if cached_answer is not None:
+            if speculative is not None:
+                speculative.cancel()
+            print(f"Condense plan: {plan}, answered from the response cache in {time.perf_counter() - start:.3f}s")
+            return self._output(cached_answer, [], new_question)
+        if speculative is not None and normalize_question(new_question) == normalize_question(question):
+            docs, timings["retrieve"] = await speculative
+        else:
+            if speculative is not None:
+                plan = "rewrite_retrieve"
+                speculative.cancel()
+            docs, timings["retrieve"] = await self._atimed_docs(new_question, inputs, _run_manager)
+
+        answer_start = time.perf_counter()
+        answer = await self.combine_docs_chain.arun(
+            input_documents=docs,
+            callbacks=_run_manager.get_child(),
+            **self._answer_inputs(inputs, new_question, chat_history_str)
+        )
+        timings["answer"] = time.perf_counter() - answer_start
+        await asyncio.to_thread(self._cache_store, plan, new_question, answer, embedding)
+        timings["total"] = time.perf_counter() - start
+        print(f"Condense plan: {plan}, stage timings (s): { {k: round(v, 3) for k, v in timings.items()} }")
+        return self._output(answer, docs, new_question)
@@ -0,0 +1,172 @@
+"""Retriever querying several Kendra indexes and query rewrites in parallel."""
+from __future__ import annotations
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+
+from .kendra_results import kendra_query, kendra_aquery, kendra_async_client, kendra_query_cache
+from resource_registry import registry
+import asyncio
+import boto3
+import math
+import time
+from botocore.config import Config
+
+CONFIDENT_SCORES = ("VERY_HIGH", "HIGH")
+
+def reciprocal_rank_fusion(doc_lists, rrf_k=60):
+    """Merge ranked result lists by reciprocal rank fusion, de-duplicated by DocumentURI."""
+    scores = {}
+    docs = {}
+    for doc_list in doc_lists:
+        for rank, doc in enumerate(doc_list):
+            source = doc.metadata["source"]
+            scores[source] = scores.get(source, 0.0) + 1.0 / (rrf_k + rank + 1)
+            docs.setdefault(source, doc)
+    merged = sorted(docs, key=lambda source: scores[source], reverse=True)
+    for source in merged:
+        docs[source].metadata["rrf_score"] = scores[source]
+    return [docs[source] for source in merged]
+
+def count_confident(doc_lists):
+    return len({d.metadata["source"] for docs in doc_lists for d in docs
+                if d.metadata.get("score") in CONFIDENT_SCORES})
+
+class KendraFanOutRetriever(BaseRetriever):
+    """Retriever to query several Amazon Kendra indexes, possibly in different regions,
+    with the question and its rewrites in parallel.
+
+    The results are merged with reciprocal rank fusion. The retriever stops waiting
+    for slower sources as soon as k high-confidence documents arrived or the budget
+    is spent.
+
+    Example:
+        .. code-block:: python
+
+            retriever = KendraFanOutRetriever(
+                sources=[("index-1", "us-east-1"), ("index-2", "eu-west-1")])
+
+    """
+
+    sources: List[Tuple[str, str]]
+    """(Kendra index id, AWS region) pairs to query"""
+    k: int
+    """Number of documents to return."""
+    per_source_timeout: float
+    """Seconds to wait for a single Kendra call."""
+    budget: float
+    """Seconds to wait for all sources."""
+    query_rewriter: Optional[Callable[[str], List[str]]]
+    """Function returning additional queries for a question."""
+    api: str
+    """Kendra API to use, "query" for excerpts or "retrieve" for longer passages."""
+    attribute_filter: Optional[Dict]
+    """Kendra AttributeFilter to restrict the searched documents."""
+    cache: Any
+    """KendraQueryCache for the query results, None to disable caching."""
+    kclients: Dict[str, Any]
+    """boto3 Kendra clients per region."""
+    max_workers: int
+    """Threads of the executor shared by the retrievers of the container for the sync Kendra calls."""
+
+    def __init__(self, sources, k=3, per_source_timeout=2.0, budget=3.0, query_rewriter=None,
+                 api="query", attribute_filter=None, cache=kendra_query_cache, max_workers=32):
+        timeout = math.ceil(per_source_timeout)
+        config = Config(connect_timeout=timeout, read_timeout=timeout, retries={"max_attempts": 1})
+        super().__init__(
+            sources=sources,
+            k=k,
+            per_source_timeout=per_source_timeout,
+            budget=budget,
+            query_rewriter=query_rewriter,
+            api=api,
+            attribute_filter=attribute_filter,
+            cache=cache,
+            kclients={region: boto3.client('kendra', region_name=region, config=config)
+                      for region in {region for _, region in sources}},
+            max_workers=max_workers
+        )
+
+    def _queries(self, query: str) -> List[str]:
+        return [query] + (self.query_rewriter(query) if self.query_rewriter else [])
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        """Query all sources with the question and its rewrites and get top k fused documents
+
+        docs = get_relevant_documents('This is my query')
+        """
+        deadline = time.monotonic() + self.budget
+        queries = self._queries(query)
+        # Calls still running after an early return finish in the shared threads, so a warm
+        # container never runs more than max_workers Kendra calls
+        executor = registry.get(
+            ("executor", "kendra_fanout", self.max_workers),
+            lambda: ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="kendra-fanout")
+        )
+        pending = {
+            executor.submit(kendra_query, self.kclients[region], q, self.k, index_id, self.cache,
+                            self.api, self.attribute_filter)
+            for index_id, region in self.sources
+            for q in queries
+        }
+        results = []
+        try:
+            while pending and count_confident(results) < self.k:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        print(f"Kendra source failed: {e}")
+        finally:
+            # Calls that have not started are dropped
+            for future in pending:
+                future.cancel()
+        if pending:
+            print(f"Skipped {len(pending)} slow Kendra sources")
+        return reciprocal_rank_fusion(results)[:self.k]
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        """Asyncio version of get_relevant_documents using aiobotocore clients
+
+        docs = await aget_relevant_documents('This is my query')
+        """
+        async def source_query(index_id, region, q):
+            kclient = await kendra_async_client(region)
+            return await asyncio.wait_for(
+                kendra_aquery(kclient, q, self.k, index_id, self.cache, self.api, self.attribute_filter),
+                self.per_source_timeout
+            )
+
+        deadline = time.monotonic() + self.budget
+        pending = {
+            asyncio.ensure_future(source_query(index_id, region, q))
+            for index_id, region in self.sources
+            for q in self._queries(query)
+        }
+        results = []
+        try:
+            while pending and count_confident(results) < self.k:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        results.append(task.result())
+                    except Exception as e:
+                        print(f"Kendra source failed: {e}")
+        finally:
+            for task in pending:
+                task.cancel()
+        return reciprocal_rank_fusion(results)[:self.k]
@@ -3,9 +3,11 @@ from __future__ import annotations
 
 from typing import Any, Dict, List, Optional
 
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
 from langchain.schema import BaseRetriever, Document
 
-from .kendra_results import kendra_query, kendra_client
+from .kendra_results import kendra_query, kendra_aquery, kendra_client, kendra_async_client, kendra_query_cache, merge_documents
+import asyncio
 import boto3
 
 class KendraIndexRetriever(BaseRetriever):
@@ -28,21 +30,54 @@ class KendraIndexRetriever(BaseRetriever):
     """Whether source documents to be returned """
     kclient: Any
     """ boto3 client for Kendra. """
-    
-    def __init__(self, kendraindex, awsregion, k=3, return_source_documents=False):
-        self.kendraindex = kendraindex
-        self.awsregion = awsregion
-        self.k = k
-        self.return_source_documents = return_source_documents
-        self.kclient = kendra_client(self.kendraindex, self.awsregion)
-        
-    def get_relevant_documents(self, query: str) -> List[Document]:
+    cache: Any
+    """KendraQueryCache for the query results, None to disable caching."""
+    api: str
+    """Kendra API to use, "query" for excerpts or "retrieve" for longer passages."""
+    attribute_filter: Optional[Dict]
+    """Kendra AttributeFilter to restrict the searched documents."""
+
+    def __init__(self, kendraindex, awsregion, k=3, return_source_documents=False, cache=kendra_query_cache,
+                 api="query", attribute_filter=None):
+        super().__init__(
+            kendraindex=kendraindex,
+            awsregion=awsregion,
+            k=k,
+            return_source_documents=return_source_documents,
+            kclient=kendra_client(kendraindex, awsregion),
+            cache=cache,
+            api=api,
+            attribute_filter=attribute_filter
+        )
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
         """Run search on Kendra index and get top k documents
 
         docs = get_relevant_documents('This is my query')
         """
-        docs = kendra_query(self.kclient, query, self.k, self.kendraindex)
+        docs = kendra_query(self.kclient, query, self.k, self.kendraindex, self.cache,
+                            self.api, self.attribute_filter)
         return docs
-    
-    async def aget_relevant_documents(self, query: str) -> List[Document]:
-        return await super().aget_relevant_documents(query)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        """Run search on Kendra index with a non-blocking aiobotocore client and get top k documents
+
+        docs = await aget_relevant_documents('This is my query')
+        """
+        kclient = await kendra_async_client(self.awsregion)
+        docs = await kendra_aquery(kclient, query, self.k, self.kendraindex, self.cache,
+                                   self.api, self.attribute_filter)
+        return docs
+
+    async def aget_relevant_documents_multi(self, queries: List[str]) -> List[Document]:
+        """Run several queries concurrently, e.g. the original and the condensed question,
+        and merge the results without duplicate DocumentURIs
+
+        docs = await aget_relevant_documents_multi(['my question', 'my standalone question'])
+        """
+        results = await asyncio.gather(*[self.aget_relevant_documents(q) for q in queries])
+        return merge_documents(results)
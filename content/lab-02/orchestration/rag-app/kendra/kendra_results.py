@@ -1,33 +1,334 @@
 from langchain.docstore.document import Document
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+import asyncio
 import boto3
+import json
+import math
 import re
+import threading
+import time
+import weakref
 
-def clean_result(res_text):
-    res = re.sub("\s+", " ", res_text).replace("...","")
+from resource_registry import registry
+
+# Highlight tags some connectors leave in the excerpts
+_HIGHLIGHT_TAGS = re.compile(r"</?(?:em|b|strong|mark)>")
+
+def clean_result(res_text, max_bytes=None):
+    """Collapse whitespace, drop "..." and highlight tags, and cut the text to max_bytes of UTF-8."""
+    if "<" in res_text:
+        res_text = _HIGHLIGHT_TAGS.sub("", res_text)
+    # str.split collapses the same whitespace as the \s+ regex in one C-level pass,
+    # a leading or trailing run is kept as a single space
+    res = " ".join(res_text.split())
+    if res_text[:1].isspace():
+        res = " " + res if res else " "
+    if res_text[-1:].isspace() and res != " ":
+        res += " "
+    res = res.replace("...", "")
+    if max_bytes is not None and len(res) * 4 > max_bytes:
+        res = res.encode("utf-8")[:max_bytes].decode("utf-8", "ignore")
     return res
-    
-def get_top_n_results(resp, count):
-    r = resp["ResultItems"][count]
+
+def query_result_to_document(r):
+    """Build a Document from a Query API result item in a single pass."""
     doc_title = r["DocumentTitle"]["Text"]
-    doc_uri = r["DocumentURI"]
-    r_type = r["Type"]
     if (r["AdditionalAttributes"] and r["AdditionalAttributes"][0]["Key"] == "AnswerText"):
         res_text = r["AdditionalAttributes"][0]["Value"]["TextWithHighlightsValue"]["Text"]
     else:
         res_text = r["DocumentExcerpt"]["Text"]
     doc_excerpt = clean_result(res_text)
-    combined_text = "Document Title: " + doc_title + "\nDocument Excerpt: \n" + doc_excerpt + "\n"
-    return {"page_content":combined_text, "metadata":{"source":doc_uri, "title": doc_title, "excerpt": doc_excerpt, "type": r_type}}
+    return Document(
+        page_content = f"Document Title: {doc_title}\nDocument Excerpt: \n{doc_excerpt}\n",
+        metadata = {
+            "source": r["DocumentURI"],
+            "title": doc_title,
+            "excerpt": doc_excerpt,
+            "type": r["Type"],
+            "score": r.get("ScoreAttributes", {}).get("ScoreConfidence"),
+        }
+    )
 
-def kendra_query(kclient, kquery, kcount, kindex_id):
-    response = kclient.query(IndexId=kindex_id, QueryText=kquery.strip())
-    if len(response["ResultItems"]) > kcount:
-        r_count = kcount
-    else:
-        r_count = len(response["ResultItems"])
-    docs = [get_top_n_results(response, i) for i in range(0, r_count)]
-    return [Document(page_content = d["page_content"], metadata = d["metadata"]) for d in docs]
+def retrieve_result_to_document(r):
+    """Build a Document from a Retrieve API result item in a single pass."""
+    doc_title = r["DocumentTitle"]
+    doc_excerpt = clean_result(r["Content"])
+    return Document(
+        page_content = f"Document Title: {doc_title}\nDocument Excerpt: \n{doc_excerpt}\n",
+        metadata = {
+            "source": r["DocumentURI"],
+            "title": doc_title,
+            "excerpt": doc_excerpt,
+            "type": "PASSAGE",
+            "score": r.get("ScoreAttributes", {}).get("ScoreConfidence"),
+        }
+    )
+
+def get_top_n_results(resp, count):
+    doc = query_result_to_document(resp["ResultItems"][count])
+    return {"page_content": doc.page_content, "metadata": doc.metadata}
+
+class DynamoDBCacheStore:
+    """Shared persistence for KendraQueryCache in a DynamoDB table with the CacheKey
+    partition key and the ExpiresAt TTL attribute."""
+
+    def __init__(self, table_name, region_name=None, ddb_client=None):
+        self.table_name = table_name
+        self.ddb_client = boto3.client('dynamodb', region_name=region_name) if ddb_client is None else ddb_client
+
+    def get(self, key):
+        item = self.ddb_client.get_item(TableName=self.table_name, Key={"CacheKey": {"S": key}}).get("Item")
+        # DynamoDB deletes expired items lazily, check the expiry time
+        if item is None or float(item["ExpiresAt"]["N"]) < time.time():
+            return None
+        return json.loads(item["Value"]["S"])
+
+    def put(self, key, value, ttl):
+        self.ddb_client.put_item(
+            TableName=self.table_name,
+            Item={
+                "CacheKey": {"S": key},
+                "Value": {"S": json.dumps(value)},
+                "ExpiresAt": {"N": str(int(time.time() + ttl))},
+            },
+        )
+
+class KendraQueryCache:
+    """Size-bounded LRU cache of Kendra query results with TTL.
+
+    Entries are lists of Documents keyed by index id, API, number of results,
+    normalized query text and attribute filter.
+    An optional store, e.g. DynamoDBCacheStore, shares the results across containers.
+    """
+
+    def __init__(self, ttl=300, max_size=256, store=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(kindex_id, kquery, kcount, api="query", attribute_filter=None):
+        key = f"{kindex_id}|{api}|{kcount}|{' '.join(kquery.lower().split())}"
+        if attribute_filter:
+            key += "|" + json.dumps(attribute_filter, sort_keys=True)
+        return key
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        value = self.store.get(key) if self.store is not None else None
+        if value is not None:
+            value = [Document(page_content = d["page_content"], metadata = d["metadata"]) for d in value]
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._put_local(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._put_local(key, value)
+        if self.store is not None:
+            self.store.put(key, [{"page_content": d.page_content, "metadata": d.metadata} for d in value], self.ttl)
+
+    def _put_local(self, key, value):
+        self._entries[key] = (time.time() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+kendra_query_cache = KendraQueryCache()
+
+def _request_kwargs(kquery, kcount, kindex_id, attribute_filter):
+    kwargs = {"IndexId": kindex_id, "QueryText": kquery.strip(), "PageSize": kcount}
+    if attribute_filter:
+        kwargs["AttributeFilter"] = attribute_filter
+    return kwargs
+
+def _to_documents(response, kcount, api):
+    to_document = retrieve_result_to_document if api == "retrieve" else query_result_to_document
+    return [to_document(r) for r in response["ResultItems"][:kcount]]
+
+def kendra_query(kclient, kquery, kcount, kindex_id, cache=kendra_query_cache, api="query", attribute_filter=None):
+    """Get the top kcount results for a query as Documents.
+
+    Kendra returns only kcount results (PageSize). With api="retrieve" the Retrieve API
+    returns longer passages instead of the Query API excerpts. An optional Kendra
+    AttributeFilter restricts the searched documents.
+    """
+    key = cache.cache_key(kindex_id, kquery, kcount, api, attribute_filter) if cache is not None else None
+    docs = cache.get(key) if cache is not None else None
+    if docs is None:
+        kwargs = _request_kwargs(kquery, kcount, kindex_id, attribute_filter)
+        response = kclient.retrieve(**kwargs) if api == "retrieve" else kclient.query(**kwargs)
+        docs = _to_documents(response, kcount, api)
+        if cache is not None:
+            cache.put(key, docs)
+    return [Document(page_content = d.page_content, metadata = dict(d.metadata)) for d in docs]
+
+async def kendra_aquery(kclient, kquery, kcount, kindex_id, cache=kendra_query_cache, api="query", attribute_filter=None):
+    """Asyncio version of kendra_query, kclient is an aiobotocore Kendra client, see kendra_async_client."""
+    key = cache.cache_key(kindex_id, kquery, kcount, api, attribute_filter) if cache is not None else None
+    docs = cache.get(key) if cache is not None else None
+    if docs is None:
+        kwargs = _request_kwargs(kquery, kcount, kindex_id, attribute_filter)
+        response = await (kclient.retrieve(**kwargs) if api == "retrieve" else kclient.query(**kwargs))
+        docs = _to_documents(response, kcount, api)
+        if cache is not None:
+            cache.put(key, docs)
+    return [Document(page_content = d.page_content, metadata = dict(d.metadata)) for d in docs]
+
+def merge_documents(doc_lists):
+    """Merge ranked result lists rank by rank, dropping documents with an already seen DocumentURI."""
+    seen = set()
+    merged = []
+    for rank in range(max((len(docs) for docs in doc_lists), default=0)):
+        for docs in doc_lists:
+            if rank < len(docs) and docs[rank].metadata["source"] not in seen:
+                seen.add(docs[rank].metadata["source"])
+                merged.append(docs[rank])
+    return merged
+
+# Kendra ScoreConfidence values from most to least relevant
+SCORE_RANKS = {"VERY_HIGH": 0, "HIGH": 1, "MEDIUM": 2, "LOW": 3, "NOT_AVAILABLE": 4}
+
+def estimate_tokens(text):
+    """Rough token count of English text, about 4 characters per token."""
+    return math.ceil(len(text) / 4)
+
+def _shingles(text, size=5):
+    words = text.lower().split()
+    return {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+def _overlaps(shingles, kept_shingles, threshold):
+    return any(len(shingles & kept) >= threshold * min(len(shingles), len(kept)) for kept in kept_shingles)
+
+def _truncate_document(d, max_tokens, count_tokens):
+    """Cut the excerpt of a document at a word boundary so the document fits max_tokens."""
+    title = d.metadata.get("title", "")
+    words = d.metadata.get("excerpt", d.page_content).split()
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(f"Document Title: {title}\nDocument Excerpt: \n{' '.join(words[:middle])} ...\n") <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    if low == 0:
+        return None
+    excerpt = " ".join(words[:low]) + " ..."
+    return Document(
+        page_content = f"Document Title: {title}\nDocument Excerpt: \n{excerpt}\n",
+        metadata = {**d.metadata, "excerpt": excerpt, "truncated": True}
+    )
+
+def pack_documents(docs, token_budget, count_tokens=estimate_tokens, overlap_threshold=0.8, min_tokens=32):
+    """Select the documents to stuff into the prompt within a token budget.
+
+    The documents are ordered by Kendra score confidence, keeping the retrieval order
+    within a score. Excerpts overlapping an already selected excerpt by overlap_threshold
+    of their 5-word shingles are dropped. The first document exceeding the remaining
+    budget is truncated if at least min_tokens are left, the others are dropped.
+
+    Args:
+        docs: Retrieved Documents in retrieval order
+        token_budget: Maximum number of tokens of the packed page contents
+        count_tokens: Function returning the number of tokens of a text
+    Returns:
+        The packed Documents and the number of tokens saved
+    """
+    ordered = sorted(docs, key=lambda d: SCORE_RANKS.get(d.metadata.get("score"), len(SCORE_RANKS)))
+    total_tokens = 0
+    used_tokens = 0
+    packed = []
+    kept_shingles = []
+    for d in ordered:
+        tokens = count_tokens(d.page_content)
+        total_tokens += tokens
+        shingles = _shingles(d.metadata.get("excerpt", d.page_content))
+        if _overlaps(shingles, kept_shingles, overlap_threshold):
+            continue
+        remaining = token_budget - used_tokens
+        if tokens > remaining:
+            d = _truncate_document(d, remaining, count_tokens) if remaining >= min_tokens else None
+            if d is None:
+                continue
+            tokens = count_tokens(d.page_content)
+        packed.append(d)
+        kept_shingles.append(shingles)
+        used_tokens += tokens
+    return packed, total_tokens - used_tokens
 
 def kendra_client(kindex_id, kregion):
-    kclient = boto3.client('kendra', region_name=kregion)
-    return kclient
+    """Return the boto3 Kendra client of the region shared by the container, boto3 clients are thread-safe."""
+    return registry.client('kendra', kregion)
+
+class _LoopClients:
+    """aiobotocore Kendra clients of an event loop, entered on one AsyncExitStack."""
+
+    def __init__(self):
+        self.clients = {}
+        self.stack = AsyncExitStack()
+        self.lock = asyncio.Lock()
+        self.closer = self._close()
+
+    async def _close(self):
+        # An async generator of the loop, asyncio.run closes it with shutdown_asyncgens()
+        # before it closes the loop, which exits the clients
+        try:
+            yield
+        finally:
+            _async_clients.pop(asyncio.get_running_loop(), None)
+            await self.stack.aclose()
+
+# aiobotocore clients are bound to the event loop they were created on
+_async_clients = weakref.WeakKeyDictionary()
+
+async def kendra_async_client(kregion, max_pool_connections=50):
+    """Return the pooled aiobotocore Kendra client of the region for the running event loop.
+
+    The client is created on first use and closed by close_kendra_async_clients(), or
+    when asyncio.run() shuts the loop down, so every invocation running its own loop
+    releases its connections.
+    """
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+
+    loop = asyncio.get_running_loop()
+    loop_clients = _async_clients.get(loop)
+    if loop_clients is None:
+        loop_clients = _async_clients[loop] = _LoopClients()
+        await loop_clients.closer.__anext__()
+    async with loop_clients.lock:
+        if kregion not in loop_clients.clients:
+            loop_clients.clients[kregion] = await loop_clients.stack.enter_async_context(get_session().create_client(
+                'kendra',
+                region_name=kregion,
+                config=AioConfig(max_pool_connections=max_pool_connections)
+            ))
+    return loop_clients.clients[kregion]
+
+async def close_kendra_async_clients():
+    """Close the aiobotocore Kendra clients of the running event loop, e.g. at the end of a
+    request served by a long-lived loop."""
+    loop_clients = _async_clients.pop(asyncio.get_running_loop(), None)
+    if loop_clients is not None:
+        await loop_clients.closer.aclose()
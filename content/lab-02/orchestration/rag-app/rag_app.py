@@ -1,53 +1,58 @@
-import boto3
 import json
 import os
 
-from langchain.chains import ConversationalRetrievalChain
 from langchain.llms import SagemakerEndpoint
 from langchain.prompts import PromptTemplate
-from langchain.embeddings import SagemakerEndpointEmbeddings
-from langchain.embeddings.sagemaker_endpoint import EmbeddingsContentHandler
-from langchain.llms.sagemaker_endpoint import ContentHandlerBase, LLMContentHandler
 from langchain.memory import ConversationBufferWindowMemory
 from langchain.llms.bedrock import Bedrock
-from langchain.memory.chat_message_histories import DynamoDBChatMessageHistory
-from langchain.retrievers import AmazonKendraRetriever
-
+from chat_history import MemoryWriter, RollingSummaryMemory, WindowedDynamoDBChatMessageHistory
+from condense import FastCondenseConversationalRetrievalChain
+from kendra.kendra_fanout_retriever import KendraFanOutRetriever
+from kendra.kendra_index_retriever import KendraIndexRetriever
+from resource_registry import registry
+from response_cache import ResponseCache
+from sagemaker_content_handler import content_handler
+from streaming import StreamingBedrock, StreamingSagemakerEndpoint, TokenQueueCallbackHandler, stream_tokens
 
 REGION = os.environ.get('REGION')
 KENDRA_REGION = os.environ.get('KENDRA_REGION', os.environ.get('REGION'))
 KENDRA_INDEX_ID = os.environ.get('KENDRA_INDEX_ID')
 SM_ENDPOINT_NAME = os.environ.get('SM_ENDPOINT_NAME')
 LLM_CONTEXT_LENGTH = os.environ.get('LLM_CONTEXT_LENGTH', '2048')
+# Token budget of the retrieved excerpts in the prompt, half of LLM_CONTEXT_LENGTH if empty to leave
+# room for the prompt template, the chat history and the answer
+CONTEXT_TOKEN_BUDGET = os.environ.get('CONTEXT_TOKEN_BUDGET', '')
 BEDROCK_MODEL_ID = os.environ.get('BEDROCK_MODEL_ID', 'anthropic.claude-v2')
+# Smaller Bedrock model to rewrite follow up questions, e.g. anthropic.claude-instant-v1, BEDROCK_MODEL_ID if empty
+CONDENSE_BEDROCK_MODEL_ID = os.environ.get('CONDENSE_BEDROCK_MODEL_ID', '')
+CONDENSE_TIMEOUT = os.environ.get('CONDENSE_TIMEOUT', '5')
 KENDRA_TOP_K = os.environ.get('KENDRA_TOP_K', '3')
+# The Retrieve API returns longer passages than the excerpts of the Query API. Unlike the AmazonKendraRetriever this
+# app used before, KendraIndexRetriever does not fall back to the Query API when Retrieve finds nothing, and it
+# formats and cleans the excerpts differently, so existing deployments get different documents. Set "query" for
+# the Query API excerpts
+KENDRA_API = os.environ.get('KENDRA_API', 'retrieve')
+KENDRA_ATTRIBUTE_FILTER = os.environ.get('KENDRA_ATTRIBUTE_FILTER', '')
+# Comma-separated list of <index id>[@<region>] to query in parallel instead of KENDRA_INDEX_ID,
+# the region defaults to KENDRA_REGION
+KENDRA_SOURCES = os.environ.get('KENDRA_SOURCES', '')
+KENDRA_SOURCE_TIMEOUT = os.environ.get('KENDRA_SOURCE_TIMEOUT', '2')
+KENDRA_FANOUT_BUDGET = os.environ.get('KENDRA_FANOUT_BUDGET', '3')
 LLM_MEMORY_TABLE = os.environ.get('LLM_MEMORY_TABLE', 'LLMRagMemoryTable')
-
-# Content Handler for Falcon40b-instruct
-class ContentHandler(LLMContentHandler):
-    content_type = "application/json"
-    accepts = "application/json"
-
-    def transform_input(self, prompt, model_kwargs):
-        input_str = json.dumps(
-            {
-                "inputs": prompt,
-                "parameters":
-                {
-                    "do_sample": False,
-                    "repetition_penalty": 1.1,
-                    "return_full_text": False,
-                    "max_new_tokens": 1024
-                }
-            }
-        )
-        return input_str.encode('utf-8')
-
-    def transform_output(self, output):
-        response_json = json.loads(output.read().decode("utf-8"))
-        return response_json[0]["generated_text"]
-
-content_handler = ContentHandler()
+# "summary" keeps a rolling summary and the last CHAT_SUMMARY_TURNS turns within CHAT_MEMORY_TOKENS,
+# "window" replays the last CHAT_WINDOW_SIZE turns
+CHAT_MEMORY_MODE = os.environ.get('CHAT_MEMORY_MODE', 'window')
+CHAT_SUMMARY_TURNS = os.environ.get('CHAT_SUMMARY_TURNS', '2')
+CHAT_MEMORY_TOKENS = os.environ.get('CHAT_MEMORY_TOKENS', '')
+CHAT_WINDOW_SIZE = os.environ.get('CHAT_WINDOW_SIZE', '3')
+# Write the chat history in the background. The stream function flushes it after the
+# last token, the REST handler flushes it before it returns, so there it only batches the writes
+CHAT_HISTORY_WRITE_BEHIND = os.environ.get('CHAT_HISTORY_WRITE_BEHIND', 'false')
+RESPONSE_CACHE_TABLE = os.environ.get('RESPONSE_CACHE_TABLE', '')
+RESPONSE_CACHE_TTL = os.environ.get('RESPONSE_CACHE_TTL', '3600')
+RESPONSE_CACHE_SIZE = os.environ.get('RESPONSE_CACHE_SIZE', '256')
+RESPONSE_CACHE_SIMILARITY = os.environ.get('RESPONSE_CACHE_SIMILARITY', '')
+BEDROCK_EMBEDDINGS_MODEL_ID = os.environ.get('BEDROCK_EMBEDDINGS_MODEL_ID', 'amazon.titan-embed-text-v1')
 
 _template = """Given the following conversation and a follow up question, rephrase the follow up question to be a standalone question, in its original language.
 
@@ -58,22 +63,179 @@ Standalone question:"""
 
 CONDENSE_QUESTION_PROMPT = PromptTemplate.from_template(_template)
 
-def get_llm(use_bedrock):
+def get_embeddings():
+    # Only needed for the similarity cache, importing the embeddings adds about 75 ms to a
+    # cold start (benchmarks/import_time_benchmark.py)
+    from langchain.embeddings import BedrockEmbeddings
+
+    return registry.get(
+        ("embeddings", "bedrock", BEDROCK_EMBEDDINGS_MODEL_ID, REGION),
+        lambda: BedrockEmbeddings(
+            client=registry.client('bedrock-runtime', REGION),
+            model_id=BEDROCK_EMBEDDINGS_MODEL_ID
+        )
+    )
+
+# Answers are cached per container and, if RESPONSE_CACHE_TABLE is set, in DynamoDB, keyed by the standalone
+# question of the condense step, a follow up that timed out in the condense step is not cached.
+# Set RESPONSE_CACHE_SIMILARITY to a cosine similarity threshold, e.g. 0.95, to also match similar questions.
+response_cache = ResponseCache(
+    table_name=RESPONSE_CACHE_TABLE,
+    region_name=REGION,
+    ttl=int(RESPONSE_CACHE_TTL),
+    max_size=int(RESPONSE_CACHE_SIZE),
+    embed=(lambda text: get_embeddings().embed_query(text)) if RESPONSE_CACHE_SIMILARITY else None,
+    similarity_threshold=float(RESPONSE_CACHE_SIMILARITY or 0.95),
+)
+
+def get_cache_namespace(use_bedrock):
+    # Keep the answers of different backends, models and knowledge bases apart
+    namespace = f"bedrock:{BEDROCK_MODEL_ID}" if use_bedrock else f"sagemaker:{SM_ENDPOINT_NAME}"
+    return namespace + f":kendra:{KENDRA_SOURCES or KENDRA_INDEX_ID}:{KENDRA_API}:{KENDRA_TOP_K}:{KENDRA_ATTRIBUTE_FILTER}"
+
+def get_llm(use_bedrock, streaming=False, bedrock_model_id=None):
     # retriever.get_relevant_documents(query)
+    # LLM instances are cached per container and reused across warm invocations
     if use_bedrock:
-        llm = Bedrock(client=boto3.client(service_name='bedrock-runtime'),
-                    model_id=BEDROCK_MODEL_ID
+        llm_class = StreamingBedrock if streaming else Bedrock
+        model_id = bedrock_model_id or BEDROCK_MODEL_ID
+        llm = registry.get(
+            ("llm", "bedrock", model_id, REGION, streaming),
+            lambda: llm_class(
+                client=registry.client('bedrock-runtime', REGION),
+                model_id=model_id
+            )
         )
     else:
         # SageMaker langchain integration, to assist invoking SageMaker endpoint.
-        llm = SagemakerEndpoint(
-            endpoint_name=SM_ENDPOINT_NAME,
-            region_name=REGION,
-            # model_kwargs={}
-            content_handler=content_handler,
+        llm_class = StreamingSagemakerEndpoint if streaming else SagemakerEndpoint
+        llm = registry.get(
+            ("llm", "sagemaker", SM_ENDPOINT_NAME, REGION, streaming),
+            lambda: llm_class(
+                endpoint_name=SM_ENDPOINT_NAME,
+                region_name=REGION,
+                # model_kwargs={}
+                content_handler=content_handler,
+            )
         )
     return llm
 
+def get_condense_question_llm(use_bedrock):
+    # Follow up questions are rewritten by the non-streaming, and possibly smaller, LLM
+    return get_llm(use_bedrock, bedrock_model_id=CONDENSE_BEDROCK_MODEL_ID)
+
+def parse_kendra_sources(sources):
+    """Parse "index-id@region" entries separated by commas, the region defaults to KENDRA_REGION."""
+    parsed = []
+    for source in sources.split(','):
+        index_id, _, region = source.partition('@')
+        if index_id.strip():
+            parsed.append((index_id.strip(), region.strip() or KENDRA_REGION))
+    return parsed
+
+def get_retriever():
+    attribute_filter = json.loads(KENDRA_ATTRIBUTE_FILTER) if KENDRA_ATTRIBUTE_FILTER else None
+    if KENDRA_SOURCES:
+        return KendraFanOutRetriever(
+            sources=parse_kendra_sources(KENDRA_SOURCES),
+            k=int(KENDRA_TOP_K),
+            per_source_timeout=float(KENDRA_SOURCE_TIMEOUT),
+            budget=float(KENDRA_FANOUT_BUDGET),
+            api=KENDRA_API,
+            attribute_filter=attribute_filter
+        )
+
+    # By default this retriever is using the new Kendra retrieve API https://aws.amazon.com/blogs/machine-learning/quickly-build-high-accuracy-generative-ai-applications-on-enterprise-data-using-amazon-kendra-langchain-and-large-language-models/
+    return KendraIndexRetriever(
+        kendraindex=KENDRA_INDEX_ID,
+        awsregion=KENDRA_REGION,
+        k=int(KENDRA_TOP_K),
+        api=KENDRA_API,
+        attribute_filter=attribute_filter
+    )
+
+def get_memory_writer():
+    return registry.get(("memory_writer", REGION), lambda: MemoryWriter(registry.client('dynamodb', REGION)))
+
+def flush_chat_history():
+    # Lambda freezes the container once the response is sent, so the history is written before.
+    # The rolling summary is not waited for, it is updated in parallel with the next request
+    if CHAT_HISTORY_WRITE_BEHIND == 'true' and not get_memory_writer().flush():
+        print("Chat history not written yet, kept for the next request")
+
+def get_memory(session_id, summary_llm, memory_key="history"):
+    writer = get_memory_writer() if CHAT_HISTORY_WRITE_BEHIND == 'true' else None
+    if CHAT_MEMORY_MODE == 'summary':
+        turns = int(CHAT_SUMMARY_TURNS)
+        # A few more turns than kept verbatim are read, in case the last summary update is still running
+        message_history = WindowedDynamoDBChatMessageHistory(
+            table_name=LLM_MEMORY_TABLE,
+            session_id=session_id,
+            max_messages=2 * (turns + 3),
+            region_name=REGION,
+            writer=writer
+        )
+        return RollingSummaryMemory(
+            llm=summary_llm,
+            memory_key=memory_key,
+            chat_memory=message_history,
+            return_messages=True,
+            k=turns,
+            max_token_limit=int(CHAT_MEMORY_TOKENS or int(LLM_CONTEXT_LENGTH) // 4)
+        )
+
+    # Only the messages of the last CHAT_WINDOW_SIZE turns are read from DynamoDB
+    message_history = WindowedDynamoDBChatMessageHistory(
+        table_name=LLM_MEMORY_TABLE,
+        session_id=session_id,
+        max_messages=2 * int(CHAT_WINDOW_SIZE),
+        region_name=REGION,
+        writer=writer
+    )
+    return ConversationBufferWindowMemory(
+        memory_key=memory_key,
+        chat_memory=message_history,
+        return_messages=True,
+        k=int(CHAT_WINDOW_SIZE)
+    )
+
+def get_chain(llm, session_id, condense_question_llm=None, cache_namespace=""):
+    # The smaller condense question LLM also writes the conversation summary
+    memory = get_memory(session_id, condense_question_llm or llm, memory_key="chat_history")
+
+    retriever = registry.get(("retriever", "kendra", KENDRA_SOURCES or KENDRA_INDEX_ID, KENDRA_REGION), get_retriever)
+
+    # Skips the condense question LLM call for first and self-contained questions and
+    # retrieves for the raw question while a follow up question is rewritten
+    qa = FastCondenseConversationalRetrievalChain.from_llm(
+        llm=llm,
+        retriever=retriever,
+        memory=memory,
+        condense_question_prompt=CONDENSE_QUESTION_PROMPT,
+        condense_question_llm=condense_question_llm,
+        condense_timeout=float(CONDENSE_TIMEOUT),
+        context_token_budget=int(CONTEXT_TOKEN_BUDGET or int(LLM_CONTEXT_LENGTH) // 2),
+        response_cache=response_cache,
+        cache_namespace=cache_namespace,
+        verbose=True
+    )
+    return qa
+
+def stream_response(body):
+    """Run the RAG chain for a request body and yield the answer tokens as the LLM generates them.
+    Used by stream_server.py behind a Lambda function URL with response streaming."""
+    use_bedrock = body.get('USE_BEDROCK')
+    # The condensed question comes from the non-streaming LLM, so only the answer tokens are forwarded,
+    # a cached answer is sent as a single chunk
+    qa = get_chain(
+        get_llm(use_bedrock, streaming=True),
+        body['uuid'],
+        condense_question_llm=get_condense_question_llm(use_bedrock),
+        cache_namespace=get_cache_namespace(use_bedrock)
+    )
+    handler = TokenQueueCallbackHandler()
+    return stream_tokens(lambda: qa.run(body['query'], callbacks=[handler]), handler)
+
 def lambda_handler(event, context):
 
     try:
@@ -90,34 +252,15 @@ def lambda_handler(event, context):
         print(use_bedrock)
 
         llm = get_llm(use_bedrock)
-
-        message_history = DynamoDBChatMessageHistory(
-            table_name=LLM_MEMORY_TABLE,
-            session_id=uuid
-        )
-        memory = ConversationBufferWindowMemory(
-            memory_key="chat_history",
-            chat_memory=message_history,
-            return_messages=True,
-            k=3
-        )
-
-        # This retriever is using the new Kendra retrieve API https://aws.amazon.com/blogs/machine-learning/quickly-build-high-accuracy-generative-ai-applications-on-enterprise-data-using-amazon-kendra-langchain-and-large-language-models/
-        retriever = AmazonKendraRetriever(
-            index_id=KENDRA_INDEX_ID,
-            region_name=KENDRA_REGION,
-            top_k=int(KENDRA_TOP_K)
-        )
-
-        qa = ConversationalRetrievalChain.from_llm(
-            llm=llm,
-            retriever=retriever,
-            memory=memory,
-            condense_question_prompt=CONDENSE_QUESTION_PROMPT,
-            verbose=True
+        qa = get_chain(
+            llm,
+            uuid,
+            condense_question_llm=get_condense_question_llm(use_bedrock),
+            cache_namespace=get_cache_namespace(use_bedrock)
         )
 
         response = qa.run(query)
+        print(registry.stats())
         clean_response = response.replace('\n','').strip()
         status_code = 200
         print(clean_response)
@@ -125,6 +268,7 @@ def lambda_handler(event, context):
         print(e)
         status_code = 500
         clean_response = e
+    flush_chat_history()
     return {
         'statusCode': status_code,
         'body': json.dumps(f'{clean_response}')
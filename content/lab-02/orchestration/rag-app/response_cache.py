@@ -0,0 +1,230 @@
+import hashlib
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+from resource_registry import registry
+
+
+def normalize_question(question: str) -> str:
+    """Lowercase the question, collapse whitespace and drop trailing punctuation."""
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").lower()
+
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class ResponseCache:
+    """Two-tier cache of LLM answers to standalone questions.
+
+    The in-process tier is a size-bounded LRU with TTL and is kept across warm
+    invocations. The optional shared tier is a DynamoDB table with the CacheKey
+    partition key and the ExpiresAt TTL attribute. Entries are keyed by a namespace,
+    e.g. backend, model id and retrieval context, so answers never leak across
+    backends.
+
+    With an embed function and a similarity threshold, a question that misses the
+    exact lookup is matched against the embeddings of the in-process entries.
+    """
+
+    def __init__(
+        self,
+        table_name: str = "",
+        region_name: Optional[str] = None,
+        ttl: int = 3600,
+        max_size: int = 256,
+        embed: Optional[Callable[[str], List[float]]] = None,
+        similarity_threshold: float = 0.95
+    ) -> None:
+        """
+        Args:
+            table_name: DynamoDB table of the shared tier, in-process tier only if empty.
+            region_name: AWS region of the DynamoDB table.
+            ttl: Seconds an answer stays in the cache.
+            max_size: Maximum number of entries of the in-process tier.
+            embed: Function returning the embedding of a question, disables the similarity lookup if None.
+            similarity_threshold: Minimum cosine similarity for a similarity hit.
+        """
+        self.table_name = table_name
+        self.region_name = region_name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @staticmethod
+    def cache_key(namespace: str, question: str) -> str:
+        return hashlib.sha256(f"{namespace}\n{normalize_question(question)}".encode("utf-8")).hexdigest()
+
+    def _get_local(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires_at"] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry["answer"]
+
+    def _put_local(self, key: str, namespace: str, answer: str, expires_at: float, embedding: Any = None) -> None:
+        with self._lock:
+            self._entries[key] = {
+                "namespace": namespace,
+                "answer": answer,
+                "expires_at": expires_at,
+                "embedding": embedding,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _get_similar(self, namespace: str, embedding: List[float]) -> Optional[str]:
+        now = time.time()
+        best_key, best_score = None, self.similarity_threshold
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry["namespace"] != namespace or entry["embedding"] is None or entry["expires_at"] < now:
+                    continue
+                score = cosine_similarity(embedding, entry["embedding"])
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key]["answer"]
+
+    def _get_shared(self, key: str, namespace: str) -> Optional[str]:
+        item = registry.client("dynamodb", self.region_name).get_item(
+            TableName=self.table_name,
+            Key={"CacheKey": {"S": key}},
+        ).get("Item")
+        # DynamoDB deletes expired items lazily, check the expiry time
+        if item is None or float(item["ExpiresAt"]["N"]) <= time.time():
+            return None
+        self._put_local(key, namespace, item["Answer"]["S"], float(item["ExpiresAt"]["N"]))
+        return item["Answer"]["S"]
+
+    def _failed(self, action: str, error: Exception) -> None:
+        # A cache never fails a request, the failed tier is skipped
+        with self._lock:
+            self.errors += 1
+        print(f"Response cache {action} failed, skipping it: {error!r}")
+
+    def lookup(self, namespace: str, question: str) -> Tuple[Optional[str], Optional[List[float]]]:
+        """Look up the cached answer to the question.
+
+        A tier that fails, e.g. a throttled DynamoDB table or a failed embedding call,
+        is logged and counts as a miss.
+
+        Returns:
+            The answer or None, and the embedding of the question if the similarity
+            lookup computed it. Pass the embedding to store() on a miss, so the
+            question is embedded only once.
+        """
+        key = self.cache_key(namespace, question)
+        embedding = None
+        answer = self._get_local(key)
+        if answer is None and self.table_name:
+            try:
+                answer = self._get_shared(key, namespace)
+            except Exception as e:
+                self._failed("DynamoDB lookup", e)
+        if answer is None and self.embed is not None:
+            try:
+                embedding = self.embed(normalize_question(question))
+            except Exception as e:
+                self._failed("embedding", e)
+            else:
+                answer = self._get_similar(namespace, embedding)
+
+        with self._lock:
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return answer, embedding
+
+    def store(self, namespace: str, question: str, answer: str, embedding: Optional[List[float]] = None) -> None:
+        """Cache the answer to the question in both tiers, a tier that fails is logged and skipped.
+
+        Args:
+            embedding: Embedding of the question returned by lookup(), computed if None.
+        """
+        key = self.cache_key(namespace, question)
+        expires_at = time.time() + self.ttl
+        if embedding is None and self.embed is not None:
+            try:
+                embedding = self.embed(normalize_question(question))
+            except Exception as e:
+                self._failed("embedding", e)
+        self._put_local(key, namespace, answer, expires_at, embedding)
+        if self.table_name:
+            try:
+                registry.client("dynamodb", self.region_name).put_item(
+                    TableName=self.table_name,
+                    Item={
+                        "CacheKey": {"S": key},
+                        "Answer": {"S": answer},
+                        "ExpiresAt": {"N": str(int(expires_at))},
+                    },
+                )
+            except Exception as e:
+                self._failed("DynamoDB store", e)
+
+
+def is_standalone(chain: Any) -> bool:
+    """A question is standalone if the session has no chat history yet."""
+    return not chain.memory.chat_memory.messages
+
+
+def save_turn(chain: Any, question: str, answer: str) -> None:
+    """Save a cached answer to the chat history as if the chain had generated it."""
+    chain.memory.save_context({chain.input_keys[0]: question}, {chain.output_keys[0]: answer})
+
+
+def run_cached(cache: ResponseCache, chain: Any, question: str, namespace: str) -> str:
+    """Run the chain for the question, answering standalone questions from the cache."""
+    if not is_standalone(chain):
+        return chain.run(question)
+    answer, embedding = cache.lookup(namespace, question)
+    if answer is not None:
+        save_turn(chain, question, answer)
+        return answer
+    answer = chain.run(question)
+    cache.store(namespace, question, answer, embedding)
+    return answer
+
+
+def stream_cached(
+    cache: ResponseCache,
+    chain: Any,
+    question: str,
+    namespace: str,
+    stream: Callable[[], Iterator[str]]
+) -> Iterator[str]:
+    """Streaming version of run_cached, a cached answer is sent as a single chunk."""
+    if not is_standalone(chain):
+        yield from stream()
+        return
+    answer, embedding = cache.lookup(namespace, question)
+    if answer is not None:
+        save_turn(chain, question, answer)
+        yield answer
+        return
+    tokens = []
+    for token in stream():
+        tokens.append(token)
+        yield token
+    cache.store(namespace, question, "".join(tokens), embedding)
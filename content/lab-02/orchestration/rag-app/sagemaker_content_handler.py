@@ -0,0 +1,29 @@
+import json
+
+from langchain.llms.sagemaker_endpoint import LLMContentHandler
+
+# Content Handler for Falcon40b-instruct
+class ContentHandler(LLMContentHandler):
+    content_type = "application/json"
+    accepts = "application/json"
+
+    def transform_input(self, prompt, model_kwargs):
+        input_str = json.dumps(
+            {
+                "inputs": prompt,
+                "parameters":
+                {
+                    "do_sample": False,
+                    "repetition_penalty": 1.1,
+                    "return_full_text": False,
+                    "max_new_tokens": 1024
+                }
+            }
+        )
+        return input_str.encode('utf-8')
+
+    def transform_output(self, output):
+        response_json = json.loads(output.read().decode("utf-8"))
+        return response_json[0]["generated_text"]
+
+content_handler = ContentHandler()
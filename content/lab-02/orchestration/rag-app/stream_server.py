@@ -0,0 +1,50 @@
+"""HTTP server streaming LLM tokens, run behind the AWS Lambda Web Adapter.
+
+The Lambda Web Adapter forwards the function URL requests to this server and, with
+AWS_LWA_INVOKE_MODE=response_stream, passes the chunked response through to the
+client as the tokens are generated.
+"""
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from rag_app import flush_chat_history, stream_response
+
+PORT = int(os.environ.get('PORT', '8080'))
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        # Readiness check of the Lambda Web Adapter
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        print(body)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for token in stream_response(body):
+                if token:
+                    self.write_chunk(token.encode("utf-8"))
+        except Exception as e:
+            print(e)
+            self.write_chunk(f"\n{e}".encode("utf-8"))
+        # The client has all tokens, write the chat history before the response ends and Lambda freezes
+        flush_chat_history()
+        self.write_chunk(b"")
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+if __name__ == "__main__":
+    ThreadingHTTPServer(("0.0.0.0", PORT), StreamHandler).serve_forever()
@@ -0,0 +1,183 @@
+import json
+import queue
+import threading
+from collections import deque
+from typing import Any, Callable, Iterator, List, Optional
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.llms.bedrock import Bedrock, LLMInputOutputAdapter
+from langchain.llms.sagemaker_endpoint import SagemakerEndpoint
+from langchain.llms.utils import enforce_stop_tokens
+
+# Field with the generated text in the Bedrock response stream chunks per model provider
+BEDROCK_STREAM_OUTPUT_KEYS = {
+    "anthropic": "completion",
+    "amazon": "outputText",
+    "cohere": "text",
+    "meta": "generation",
+}
+
+
+# Helper for reading lines from a stream. A copy of LineIterator in notebooks/gradio_app.py, which the
+# Lambda packages cannot import, keep both in sync (benchmarks/stream_parsing_benchmark.py checks they agree)
+class LineIterator:
+    """Split the PayloadPart bytes of a SageMaker response stream into lines.
+
+    Only the partial last line is kept in the buffer. The complete lines of a part
+    are split off at once, and a part without a newline is appended without
+    scanning the buffer again.
+    """
+
+    def __init__(self, stream):
+        self.byte_iterator = iter(stream)
+        self.buffer = bytearray()
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.lines:
+            try:
+                chunk = next(self.byte_iterator)
+            except StopIteration:
+                if self.buffer:
+                    # Last line without a trailing newline
+                    line, self.buffer = bytes(self.buffer), bytearray()
+                    return line
+                raise
+            if "PayloadPart" not in chunk:
+                print(f"Unknown event type: {chunk}")
+                continue
+            data = chunk["PayloadPart"]["Bytes"]
+            if b"\n" not in data:
+                self.buffer += data
+                continue
+            if self.buffer:
+                self.buffer += data
+                data = bytes(self.buffer)
+            lines = data.split(b"\n")
+            self.buffer = bytearray(lines.pop())
+            self.lines.extend(lines)
+        return self.lines.popleft()
+
+
+def iter_tgi_tokens(event_stream: Any) -> Iterator[str]:
+    """Yield the text of the tokens from a TGI server-sent event stream."""
+    for line in LineIterator(event_stream):
+        if line.startswith(b"data:"):
+            chunk = json.loads(line[5:].decode("utf-8"))
+            if chunk["token"]["special"]:
+                continue
+            yield chunk["token"]["text"]
+
+
+class StreamingBedrock(Bedrock):
+    """Bedrock LLM that calls InvokeModelWithResponseStream and reports every chunk
+    to the callbacks with on_llm_new_token."""
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> str:
+        provider = self.model_id.split(".")[0]
+        params = {**(self.model_kwargs or {}), **kwargs}
+        body = json.dumps(LLMInputOutputAdapter.prepare_input(provider, prompt, params))
+        response = self.client.invoke_model_with_response_stream(
+            body=body,
+            modelId=self.model_id,
+            accept="application/json",
+            contentType="application/json",
+        )
+
+        text = ""
+        for event in response["body"]:
+            chunk = event.get("chunk")
+            if not chunk:
+                continue
+            token = json.loads(chunk["bytes"].decode("utf-8")).get(BEDROCK_STREAM_OUTPUT_KEYS.get(provider), "")
+            if token and run_manager:
+                run_manager.on_llm_new_token(token)
+            text += token
+        if stop is not None:
+            text = enforce_stop_tokens(text, stop)
+        return text
+
+
+class StreamingSagemakerEndpoint(SagemakerEndpoint):
+    """SageMaker LLM that calls InvokeEndpointWithResponseStream on a TGI endpoint
+    and reports every token to the callbacks with on_llm_new_token."""
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> str:
+        _model_kwargs = {**(self.model_kwargs or {}), **kwargs}
+        _endpoint_kwargs = self.endpoint_kwargs or {}
+        request = json.loads(self.content_handler.transform_input(prompt, _model_kwargs))
+        request["stream"] = True
+        response = self.client.invoke_endpoint_with_response_stream(
+            EndpointName=self.endpoint_name,
+            Body=json.dumps(request),
+            ContentType=self.content_handler.content_type,
+            **_endpoint_kwargs
+        )
+
+        text = ""
+        for token in iter_tgi_tokens(response["Body"]):
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+            text += token
+        if stop is not None:
+            text = enforce_stop_tokens(text, stop)
+        return text
+
+
+class TokenQueueCallbackHandler(BaseCallbackHandler):
+    """Callback handler that puts the generated tokens into a queue."""
+
+    def __init__(self) -> None:
+        self.queue = queue.Queue()
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.queue.put(token)
+
+
+def stream_tokens(run: Callable[[], Any], handler: TokenQueueCallbackHandler) -> Iterator[str]:
+    """Run a chain in a worker thread and yield the tokens as the LLM produces them.
+    A response produced without LLM tokens, e.g. a cached answer, is yielded as a single chunk.
+    Args:
+        run: Function running the chain with handler in its callbacks
+        handler: Handler collecting the tokens
+    Raises:
+        Exception: The exception raised by the chain
+    """
+    result = {}
+
+    def target():
+        try:
+            result["response"] = run()
+        except Exception as e:
+            result["error"] = e
+        finally:
+            handler.queue.put(None)
+
+    threading.Thread(target=target, daemon=True).start()
+    streamed = False
+    while True:
+        token = handler.queue.get()
+        if token is None:
+            break
+        streamed = True
+        yield token
+    if "error" in result:
+        raise result["error"]
+    if not streamed and isinstance(result.get("response"), str) and result["response"]:
+        yield result["response"]
@@ -1,7 +1,13 @@
 import gradio as gr
 import boto3
+import hashlib
+import itertools
 import json
-import io
+import re
+import threading
+from botocore.config import Config
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 # hyperparameters for llm
 parameters = {
@@ -18,32 +24,89 @@ system_prompt = "You are an helpful Assistant, called LLM. Knowing everyting abo
 
 # Helper for reading lines from a stream
 class LineIterator:
+    """Split the PayloadPart bytes of a SageMaker response stream into lines.
+
+    Only the partial last line is kept in the buffer. The complete lines of a part
+    are split off at once, and a part without a newline is appended without
+    scanning the buffer again.
+    """
+
     def __init__(self, stream):
         self.byte_iterator = iter(stream)
-        self.buffer = io.BytesIO()
-        self.read_pos = 0
+        self.buffer = bytearray()
+        self.lines = deque()
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        while True:
-            self.buffer.seek(self.read_pos)
-            line = self.buffer.readline()
-            if line and line[-1] == ord("\n"):
-                self.read_pos += len(line)
-                return line[:-1]
+        while not self.lines:
             try:
                 chunk = next(self.byte_iterator)
             except StopIteration:
-                if self.read_pos < self.buffer.getbuffer().nbytes:
-                    continue
+                if self.buffer:
+                    # Last line without a trailing newline
+                    line, self.buffer = bytes(self.buffer), bytearray()
+                    return line
                 raise
             if "PayloadPart" not in chunk:
-                print("Unknown event type:" + chunk)
+                print(f"Unknown event type: {chunk}")
+                continue
+            data = chunk["PayloadPart"]["Bytes"]
+            if b"\n" not in data:
+                self.buffer += data
                 continue
-            self.buffer.seek(0, io.SEEK_END)
-            self.buffer.write(chunk["PayloadPart"]["Bytes"])
+            if self.buffer:
+                self.buffer += data
+                data = bytes(self.buffer)
+            lines = data.split(b"\n")
+            self.buffer = bytearray(lines.pop())
+            self.lines.extend(lines)
+        return self.lines.popleft()
+
+
+def iter_sse_data(stream):
+    """Yield the parsed JSON payloads of the data: lines of a server-sent event stream."""
+    for line in LineIterator(stream):
+        if line.startswith(b"data:"):
+            yield json.loads(line[5:].decode("utf-8"))
+
+
+class StopSequenceMatcher:
+    """Find stop sequences in streamed text.
+
+    feed() returns the part of the text that can be shown and holds back a tail
+    that could still be the start of a stop sequence. Only the held back tail and
+    the new token are searched, so the work per token does not grow with the output.
+    """
+
+    def __init__(self, stop_sequences):
+        stop_sequences = {s for s in stop_sequences if s}
+        prefixes = {s[:i] for s in stop_sequences for i in range(1, len(s))}
+        # Never matching patterns without stop sequences
+        self.stop_pattern = re.compile("|".join(map(re.escape, stop_sequences)) or "(?!)")
+        self.tail_pattern = re.compile("(?:" + ("|".join(map(re.escape, prefixes)) or "(?!)") + r")\Z")
+        self.tail = ""
+        self.stopped = False
+
+    def feed(self, text):
+        text = self.tail + text
+        match = self.stop_pattern.search(text)
+        if match:
+            self.tail = ""
+            self.stopped = True
+            return text[:match.start()]
+        match = self.tail_pattern.search(text)
+        if match:
+            self.tail = text[match.start():]
+            return text[:match.start()]
+        self.tail = ""
+        return text
+
+    def flush(self):
+        """Return the held back text at the end of the stream."""
+        text, self.tail = self.tail, ""
+        return text
 
 
 # helper method to format prompt
@@ -59,47 +122,212 @@ LLM:"""
     return prompt
 
 
-def create_gradio_app(
-    endpoint_name, session=boto3, parameters=parameters, system_prompt=system_prompt, concurrency_count=1, share=True
+def estimate_tokens(text):
+    """Rough number of tokens of a text, about 4 characters per token."""
+    return len(text) // 4 + 1
+
+
+class PromptBuilder:
+    """Build the same prompt as format_prompt, rendering every turn of a chat only once.
+
+    The rendered history is cached per chat session under its last turn, so a new
+    message only renders the previous turn. Without a session id the history is
+    cached under a digest of all its turns, which hashes the whole history. When
+    the prompt exceeds max_prompt_tokens, the oldest turns are dropped, at least
+    drop_turns at a time. Between two drops the prompts of a chat extend each other,
+    which lets the prefix cache of the model server reuse the work of the previous
+    request.
+    """
+
+    def __init__(self, system_prompt, max_prompt_tokens=896, drop_turns=4, count_tokens=estimate_tokens,
+                 max_sessions=256):
+        self.header = f"System: {system_prompt}\n" if system_prompt else ""
+        self.max_prompt_tokens = max_prompt_tokens
+        self.drop_turns = drop_turns
+        self.count_tokens = count_tokens
+        self.max_sessions = max_sessions
+        self.header_tokens = count_tokens(self.header)
+        # history key -> (rendered turns, their token counts, rendered history)
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _keys(history, session_id):
+        """Return a function giving the key of the first size turns of the history."""
+        if session_id is not None:
+            # A chat only grows or loses its last turns, so within a session its size and last
+            # turn identify the turns before
+            return lambda size: (session_id, size) + tuple(history[size - 1]) if size else ()
+        digest = hashlib.sha256()
+        keys = [()]
+        for user_prompt, bot_response in history:
+            user_prompt, bot_response = str(user_prompt), str(bot_response)
+            # The lengths keep the turn boundaries unambiguous
+            digest.update(f"{len(user_prompt)}:{user_prompt}{len(bot_response)}:{bot_response}".encode("utf-8"))
+            keys.append((len(keys), digest.hexdigest()))
+        return keys.__getitem__
+
+    def _history_state(self, history, key):
+        # Continue from the longest cached start of the history, usually all but the last turn
+        size = len(history)
+        while size and key(size) not in self.states:
+            size -= 1
+        turns, tokens, rendered = self.states.get(key(size), ((), (), self.header))
+        for user_prompt, bot_response in history[size:]:
+            turn = f"User: {user_prompt}\nLLM: {bot_response}\n"
+            turns += (turn,)
+            tokens += (self.count_tokens(turn),)
+            rendered += turn
+        return turns, tokens, rendered
+
+    def build(self, message, history, session_id=None):
+        """Return the prompt for a message, with as many of the latest turns of history as fit.
+
+        session_id identifies the chat, e.g. the Gradio session hash.
+        """
+        key = self._keys(history, session_id)
+        turns, tokens, rendered = self._history_state(history, key)
+        question = f"User: {message}\nLLM:"
+        budget = self.max_prompt_tokens - self.header_tokens - self.count_tokens(question)
+        if sum(tokens) > budget:
+            drop = self.drop_turns
+            while drop < len(turns) and sum(tokens[drop:]) > budget:
+                drop += 1
+            turns, tokens = turns[drop:], tokens[drop:]
+            rendered = self.header + "".join(turns)
+        history_key = key(len(history))
+        with self.lock:
+            self.states[history_key] = (turns, tokens, rendered)
+            self.states.move_to_end(history_key)
+            while len(self.states) > self.max_sessions:
+                self.states.popitem(last=False)
+        return rendered + question
+
+
+class FairScheduler:
+    """Limit the concurrent requests to the endpoint and share them fairly between users.
+
+    A free slot goes to the waiting request of the user with the fewest requests in
+    flight, the oldest first, so a user sending many messages at once does not make
+    the others wait behind all of them.
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.active = {}
+        self.waiting = []
+        self.tickets = itertools.count()
+        self.condition = threading.Condition()
+
+    def _is_next(self, entry):
+        if self.in_flight >= self.max_concurrency:
+            return False
+        return entry == min(self.waiting, key=lambda w: (self.active.get(w[0], 0), w[1]))
+
+    @contextmanager
+    def slot(self, user):
+        """Wait for a free slot for the user and hold it while the block runs."""
+        entry = (user, next(self.tickets))
+        with self.condition:
+            self.waiting.append(entry)
+            try:
+                self.condition.wait_for(lambda: self._is_next(entry))
+            finally:
+                self.waiting.remove(entry)
+            self.in_flight += 1
+            self.active[user] = self.active.get(user, 0) + 1
+            # Another waiting request may fit into the remaining slots
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.active[user] -= 1
+                if not self.active[user]:
+                    del self.active[user]
+                self.condition.notify_all()
+
+
+def create_generate(
+    endpoint_name, session=boto3, parameters=parameters, system_prompt=system_prompt, concurrency_count=8,
+    max_prompt_tokens=896, max_retries=3
 ):
-    smr = session.client("sagemaker-runtime")
+    """Return the ChatInterface function streaming the answers of the endpoint,
+    at most concurrency_count at a time, shared fairly between the users."""
+    # Every streamed response holds one connection of the pool until it ends, adaptive retries
+    # back off the whole client when the endpoint throttles
+    smr = session.client("sagemaker-runtime", config=Config(
+        max_pool_connections=concurrency_count,
+        retries={"max_attempts": max_retries, "mode": "adaptive"},
+    ))
+    scheduler = FairScheduler(concurrency_count)
+    # The default fits the 1024 input tokens of the TGI container
+    prompt_builder = PromptBuilder(system_prompt, max_prompt_tokens=max_prompt_tokens)
 
     def generate(
         prompt,
         history,
+        http_request: gr.Request = None,
     ):
-        formatted_prompt = format_prompt(prompt, history, system_prompt)
+        # Gradio 3 does not pass the request to the ChatInterface function, then all users share one queue
+        session_id = getattr(http_request, "session_hash", None)
+        user = getattr(http_request, "username", None) or session_id or "anonymous"
+        formatted_prompt = prompt_builder.build(prompt, history, session_id)
 
         request = {"inputs": formatted_prompt, "parameters": parameters, "stream": True}
-        resp = smr.invoke_endpoint_with_response_stream(
-            EndpointName=endpoint_name,
-            Body=json.dumps(request),
-            ContentType="application/json",
-        )
+        with scheduler.slot(user):
+            resp = smr.invoke_endpoint_with_response_stream(
+                EndpointName=endpoint_name,
+                Body=json.dumps(request),
+                ContentType="application/json",
+            )
 
-        output = ""
-        for c in LineIterator(resp["Body"]):
-            c = c.decode("utf-8")
-            if c.startswith("data:"):
-                chunk = json.loads(c.lstrip("data:").rstrip("/n"))
-                if chunk["token"]["special"]:
-                    continue
-                if chunk["token"]["text"] in request["parameters"]["stop"]:
-                    break
-                output += chunk["token"]["text"]
-                for stop_str in request["parameters"]["stop"]:
-                    if output.endswith(stop_str):
-                        output = output[: -len(stop_str)]
-                        output = output.rstrip()
+            # ChatInterface replaces the message with every yielded value, so the text is only
+            # yielded when the matcher released new characters
+            matcher = StopSequenceMatcher(request["parameters"]["stop"])
+            output = ""
+            try:
+                for chunk in iter_sse_data(resp["Body"]):
+                    if chunk["token"]["special"]:
+                        continue
+                    delta = matcher.feed(chunk["token"]["text"])
+                    if matcher.stopped:
+                        output = (output + delta).rstrip()
+                        break
+                    if delta:
+                        output += delta
                         yield output
-
-                yield output
+                else:
+                    output += matcher.flush()
+            finally:
+                # Free the pooled connection also when the stream is left early
+                resp["Body"].close()
+        yield output
         return output
 
+    return generate
+
+
+def create_gradio_app(
+    endpoint_name, session=boto3, parameters=parameters, system_prompt=system_prompt, concurrency_count=8, share=True,
+    max_prompt_tokens=896, max_retries=3, queued_per_slot=4
+):
+    generate = create_generate(
+        endpoint_name, session, parameters, system_prompt, concurrency_count, max_prompt_tokens, max_retries
+    )
+
     with gr.Blocks() as demo:
         gr.Markdown("## Chat with Amazon SageMaker")
         gr.ChatInterface(
             generate,
         )
 
-    demo.queue(concurrency_count=concurrency_count).launch(share=share)
\ No newline at end of file
+    # More Gradio workers than endpoint slots, the requests wait in the fair scheduler instead of the FIFO queue
+    workers = concurrency_count * queued_per_slot
+    if int(gr.__version__.split(".")[0]) >= 4:
+        demo.queue(default_concurrency_limit=workers)
+    else:
+        demo.queue(concurrency_count=workers)
+    demo.launch(share=share)
\ No newline at end of file